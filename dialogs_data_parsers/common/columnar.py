@@ -0,0 +1,95 @@
+import mmap
+import os
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+from dialogs_data_parsers.utils import open_atomic
+
+_BLOB_SUFFIX = '.bin'
+_OFFSETS_SUFFIX = '.offsets'
+_ARRAY_SUFFIX = '.npy'
+
+
+class StringColumnWriter:
+    """Writes strings column: UTF-8 blob of the concatenated strings plus int64 array of their byte offsets.
+
+    Strings are streamed to the blob file, only offsets are kept in memory until `close`.
+    """
+
+    def __init__(self, dir_path, name):
+        dir_path = Path(dir_path)
+        dir_path.mkdir(exist_ok=True, parents=True)
+        self._dir_path = dir_path
+        self._name = name
+        self._blob_file = open(dir_path / (name + _BLOB_SUFFIX), 'wb')
+        self._offsets = array('q', [0])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def append(self, string):
+        data = string.encode()
+        self._blob_file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+    def close(self):
+        self._blob_file.close()
+        save_array(self._dir_path, self._name + _OFFSETS_SUFFIX, self._offsets)
+
+
+class StringColumn:
+    """Read-only memory-mapped strings column written by `StringColumnWriter`.
+
+    Strings are decoded directly from the mapped blob, so opening the column costs nothing regardless of its size. It's
+    not zero-copy though: each string is decoded to a new `str` object on access.
+    """
+
+    def __init__(self, dir_path, name):
+        dir_path = Path(dir_path)
+        self._offsets = load_array(dir_path, name + _OFFSETS_SUFFIX)
+        self._blob_file = open(dir_path / (name + _BLOB_SUFFIX), 'rb')
+
+        # Empty file can't be mapped:
+        if os.fstat(self._blob_file.fileno()).st_size:
+            self._blob = mmap.mmap(self._blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._blob)
+        else:
+            self._blob = None
+            self._view = memoryview(b'')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self._offsets[index:index + 2].tolist()
+        return str(self._view[start:end], 'utf-8')
+
+    def get_range(self, start, end):
+        """Returns list of strings with indexes in [start, end)."""
+        offsets = self._offsets[start:end + 1].tolist()
+        view = self._view
+        return [str(view[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(len(offsets) - 1)]
+
+    def close(self):
+        self._view.release()
+        if self._blob is not None:
+            self._blob.close()
+        self._blob_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def save_array(dir_path, name, values, dtype=np.int64):
+    with open_atomic(Path(dir_path) / (name + _ARRAY_SUFFIX), 'wb') as file:
+        np.save(file, np.frombuffer(values, dtype=dtype) if isinstance(values, array) else np.asarray(values, dtype))
+
+
+def load_array(dir_path, name):
+    """Loads the array saved by `save_array` as a read-only memory map."""
+    return np.load(Path(dir_path) / (name + _ARRAY_SUFFIX), mmap_mode='r')
@@ -1,42 +1,200 @@
 import asyncio
+import datetime
 import logging
+import random
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import parsedate_to_datetime
 from functools import partial
 from typing import Optional
+from urllib.parse import urlsplit
 
 import aiohttp
 
+from dialogs_data_parsers.common.page_archive import PageArchive
+from dialogs_data_parsers.common.rate_limiter import AdaptiveConcurrencyLimiter, TokenBucket
+
 _logger = logging.getLogger(__name__)
 
 
 class Crawler:
-    def __init__(self, concurrency, timeout, retries):
+    """Base class for the crawlers.
+
+    All requests are performed via one long-lived session with a keep-alive connection pool, so the connections to
+    the host are reused instead of being established for each request. The session is opened and closed by using the
+    crawler as an async context manager:
+
+        async with crawler:
+            await crawler.run()
+
+    Raw responses can be persisted to the `PageArchive`. In the replay mode, responses are taken from the archive
+    instead of the network, so the crawler re-runs only the pages parsing.
+    """
+
+    def __init__(
+            self,
+            concurrency,
+            timeout,
+            retries,
+            limit_per_host=None,
+            dns_cache_ttl=600,
+            n_parse_workers=0,
+            max_concurrency=None,
+            max_rate=None,
+            backoff_base=1.0,
+            backoff_max=60.0,
+            page_archive_dir=None,
+            replay=False):
+        """
+        :param concurrency: Initial number of concurrent requests. It's adapted to the server load (see
+            `AdaptiveConcurrencyLimiter`): decreased on 429 / 5xx responses, timeouts, connection errors and latency
+            growth (per endpoint), and increased back up to `max_concurrency` (defaults to `concurrency`) while the
+            server copes.
+        :param retries: Max number of attempts for each request. Failed attempts are retried after the random
+            exponential backoff (or after the Retry-After time, if the server sets it).
+        :param limit_per_host: Max number of simultaneous connections to the same host. Defaults to `max_concurrency`.
+        :param dns_cache_ttl: Time in seconds to keep resolved host addresses.
+        :param n_parse_workers: Number of processes for the pages parsing (see `run_in_parse_executor`). If 0, pages
+            are parsed right in the event loop.
+        :param max_rate: Optional cap on the number of requests per second.
+        :param backoff_base: Max backoff before the first retry in seconds, it's doubled with each next retry.
+        :param backoff_max: Max backoff in seconds.
+        :param page_archive_dir: Optional directory of the raw responses archive. Successful responses are added to it.
+        :param replay: If True, requests are served from the page archive only (missing pages are None). No session
+            is opened and no concurrency or rate limits are applied.
+        """
+        if replay and page_archive_dir is None:
+            raise ValueError('Replay mode requires the page archive directory')
+
+        self._max_concurrency = max(max_concurrency or concurrency, concurrency)
         self._timeout = timeout
         self._retries = retries
+        self._limit_per_host = limit_per_host or self._max_concurrency
+        self._dns_cache_ttl = dns_cache_ttl
+        self._n_parse_workers = n_parse_workers
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+
+        self._limiter = AdaptiveConcurrencyLimiter(concurrency, max_concurrency=self._max_concurrency)
+        self._token_bucket = TokenBucket(max_rate) if max_rate else None
+        self._replay = replay
+        self._page_archive = PageArchive(page_archive_dir) if page_archive_dir is not None else None
+        self._session = None
+        self._parse_executor = None
+
+    async def __aenter__(self):
+        if not self._replay:
+            connector = aiohttp.TCPConnector(
+                limit=0, limit_per_host=self._limit_per_host, ttl_dns_cache=self._dns_cache_ttl, use_dns_cache=True)
+            timeout = aiohttp.ClientTimeout(total=self._timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        if self._n_parse_workers:
+            self._parse_executor = ProcessPoolExecutor(self._n_parse_workers)
 
-        self._semaphore = asyncio.BoundedSemaphore(concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._page_archive is not None:
+            self._page_archive.close()
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown()
+            self._parse_executor = None
+
+    async def run_in_parse_executor(self, func, *args):
+        """Runs CPU-bound parsing function in the parse workers pool, so it doesn't block the network I/O.
+
+        The function must be picklable (module-level) and must return picklable result.
+        """
+        if self._parse_executor is None:
+            return func(*args)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._parse_executor, func, *args)
 
     async def perform_request(self, url, headers=None, data=None, params=None, method='get') -> Optional[str]:
         """Requests a page and returns content."""
+        loop = asyncio.get_event_loop()
+        if self._replay:
+            # Blob reading and decompression don't block the event loop (same for the archiving below):
+            get_text = partial(self._page_archive.get, url, params=params, data=data, method=method)
+            text = await loop.run_in_executor(None, get_text)
+            if text is None:
+                _logger.warning(f'Page is not in the archive: {url}')
+            return text
+
+        if self._session is None:
+            raise RuntimeError('Crawler session is not opened, use the crawler as an async context manager')
+
         _logger.debug(f'Requesting page: {url}')
-        i_retry = 0
-        async with self._get_session(headers=headers) as session:
-            while i_retry < self._retries:
+        session = self._session
+        for i_retry in range(self._retries):
+            retry_after = None
+            async with self._limiter:
+                if self._token_bucket is not None:
+                    await self._token_bucket.acquire()
+
+                start_time = loop.time()
                 try:
-                    method = session.get if method == 'get' else partial(session.post, data=data)
-                    async with self._semaphore, method(url, allow_redirects=False, params=params) as response:
+                    request = session.get if method == 'get' else partial(session.post, data=data)
+                    async with request(url, headers=headers, allow_redirects=False, params=params) as response:
                         text = await response.text()
+                        status = response.status
+                        retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+                except asyncio.TimeoutError:
+                    error = 'timeout'
+                except aiohttp.ClientError as e:
+                    error = f'{e.__class__.__name__}: {e}'
+                else:
+                    if status != 429 and status < 500:
+                        self._limiter.on_success(loop.time() - start_time, _get_request_class(url, method))
                         _logger.debug(f'Page source obtained: {url}')
+                        if self._page_archive is not None:
+                            put_text = partial(self._page_archive.put, text, url, params, data, method)
+                            await loop.run_in_executor(None, put_text)
                         return text
-                except asyncio.TimeoutError:
-                    i_retry += 1
-                    _logger.warning(f'Timeout for page [{i_retry}/{self._retries}]: {url}')
-            else:
-                _logger.warning(f'Max number of retries exceeded for page: {url}')
-                return None
-
-    def _get_session(self, headers):
-        connector = aiohttp.TCPConnector()
-        timeout = aiohttp.ClientTimeout(total=self._timeout)
-        session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
-
-        return session
+                    error = f'status {status}'
+
+                self._limiter.on_overload(error)
+                if retry_after is not None:
+                    self._limiter.pause(retry_after)
+
+            _logger.warning(f'Request failed ({error}) [{i_retry + 1}/{self._retries}]: {url}')
+            if i_retry + 1 < self._retries:
+                await asyncio.sleep(retry_after if retry_after is not None else self._get_backoff(i_retry))
+
+        _logger.warning(f'Max number of retries exceeded for page: {url}')
+        return None
+
+    def _get_backoff(self, i_retry):
+        # "Full jitter": uniformly random delay up to the exponentially growing cap.
+        return random.uniform(0, min(self._backoff_max, self._backoff_base * 2**i_retry))
+
+
+def _get_request_class(url, method):
+    """Returns the endpoint of the request: method, host and the first path segment (e.g. 'story' of the story pages
+    or 'ajax' of the comments requests). Requests of the same endpoint have comparable latencies."""
+    url_parts = urlsplit(url)
+    return method, url_parts.netloc, url_parts.path.strip('/').split('/', 1)[0]
+
+
+def _parse_retry_after(value):
+    """Returns Retry-After header delay in seconds (the header is either seconds or http date) or None."""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_time = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_time.tzinfo is None:
+        retry_time = retry_time.replace(tzinfo=datetime.timezone.utc)
+
+    return max((retry_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
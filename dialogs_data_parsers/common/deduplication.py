@@ -0,0 +1,246 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from dialogs_data_parsers.common.sharding import get_shard_range, iterate_on_file_shard_lines
+from dialogs_data_parsers.utils import merge_files
+
+_logger = logging.getLogger(__name__)
+
+_RECORD_DTYPE = np.dtype([('key', '<u8'), ('offset', '<i8')])
+_EXACT = 'exact'
+_NEAR = 'near'
+_WORD_PATTERN = re.compile(r'\w+')
+_RECORDS_BUFFER_SIZE = 1 << 20
+_MINHASH_SEED = 228
+
+
+class DialogsDeduplicator:
+    """Removes duplicate dialogs from the jsonl file (one dialog per line), keeping the first occurrence of each.
+
+    Exact duplicates are the lines with the same 64-bit fingerprint. Optional near duplicates are the dialogs which
+    share a MinHash LSH band (i.e. have similar sets of word shingles) with any previous dialog.
+
+    The memory is bounded by disk-spilling partitioned hashing:
+        1. Each worker reads its byte-range shard of the file and spills (key, line offset) records to the
+           partition files by the key (keys are fingerprints and band hashes).
+        2. Each partition fits in memory, so a worker finds the duplicate offsets in it (all, but the first
+           offset of each key) by sorting.
+        3. Each worker writes the lines of its shard, which offsets are not duplicates. Shards are concatenated.
+    """
+
+    def __init__(
+            self,
+            file_path,
+            out_file_path,
+            near_duplicates=False,
+            n_workers=None,
+            n_partitions=64,
+            tmp_dir=None,
+            n_permutations=64,
+            n_bands=16,
+            shingle_size=3):
+        """
+        :param n_partitions: Number of partitions of the records. Each worker loads one partition at a time, so the
+            memory is about 16 bytes * number of dialogs * (1 + n_bands, if near duplicates) / n_partitions.
+        :param tmp_dir: Directory for the spilled records. Defaults to the out file directory.
+        :param n_permutations: Number of MinHash permutations (must be divisible by `n_bands`).
+        :param n_bands: Number of LSH bands. More bands with fewer rows each find less similar dialogs.
+        :param shingle_size: Number of words in the shingles of the dialog text.
+        """
+        if n_permutations % n_bands:
+            raise ValueError(f'Number of permutations {n_permutations} is not divisible by number of bands {n_bands}')
+
+        self._file_path = Path(file_path)
+        self._out_file_path = Path(out_file_path)
+        self._near_duplicates = near_duplicates
+        self._kinds = (_EXACT, _NEAR) if near_duplicates else (_EXACT, )
+        self._n_workers = n_workers or os.cpu_count()
+        self._n_shards = self._n_workers * 4
+        self._n_partitions = n_partitions
+        self._tmp_dir = Path(tmp_dir) if tmp_dir else self._out_file_path.parent
+        self._n_bands = n_bands
+        self._shingle_size = shingle_size
+
+        rnd = np.random.default_rng(_MINHASH_SEED)
+        # Multiply-shift hash functions of the MinHash permutations (odd multipliers):
+        self._minhash_a = rnd.integers(0, 2**64, size=n_permutations, dtype=np.uint64) | np.uint64(1)
+        self._minhash_b = rnd.integers(0, 2**64, size=n_permutations, dtype=np.uint64)
+
+        self._work_dir = None
+
+    def run(self):
+        """Writes the deduplicated file and returns the duplicates report dict."""
+        start_time = time.time()
+        self._out_file_path.parent.mkdir(exist_ok=True, parents=True)
+        self._tmp_dir.mkdir(exist_ok=True, parents=True)
+        self._work_dir = Path(tempfile.mkdtemp(prefix=f'{self._out_file_path.stem}.dedup-', dir=self._tmp_dir))
+
+        try:
+            with multiprocessing.Pool(processes=self._n_workers) as pool:
+                n_dialogs = sum(pool.imap_unordered(self._spill_shard_records, range(self._n_shards)))
+                _logger.info(f'Records are spilled, dialogs: {n_dialogs}, elapsed: {time.time() - start_time:.1f}s')
+
+                tasks = [(kind, partition) for kind in self._kinds for partition in range(self._n_partitions)]
+                n_duplicates = dict.fromkeys(self._kinds, 0)
+                for kind, n_partition_duplicates in pool.imap_unordered(self._find_partition_duplicates, tasks):
+                    n_duplicates[kind] += n_partition_duplicates
+                _logger.info(f'Duplicates are found: {n_duplicates}, elapsed: {time.time() - start_time:.1f}s')
+
+                n_dialogs_kept = sum(pool.map(self._write_shard, range(self._n_shards)))
+
+            self._merge_shard_files()
+        finally:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+
+        report = {
+            'n_dialogs': n_dialogs,
+            'n_dialogs_kept': n_dialogs_kept,
+            'n_exact_duplicates': n_duplicates[_EXACT],
+            'exact_duplicates_rate': n_duplicates[_EXACT] / max(n_dialogs, 1),
+        }
+        if self._near_duplicates:
+            # Exact duplicates are near duplicates too, so only the rest is reported:
+            n_near_duplicates = n_dialogs - n_dialogs_kept - n_duplicates[_EXACT]
+            report['n_near_duplicates'] = n_near_duplicates
+            report['near_duplicates_rate'] = n_near_duplicates / max(n_dialogs, 1)
+        report['elapsed_time'] = time.time() - start_time
+        _logger.info(f'Deduplication is done: {report}')
+
+        return report
+
+    def _spill_shard_records(self, shard_id):
+        buffers = {kind: ([], []) for kind in self._kinds}
+        n_dialogs = 0
+
+        lines = iterate_on_file_shard_lines(self._file_path, num_shards=self._n_shards, shard_id=shard_id)
+        for offset, raw_line in lines:
+            raw_line = raw_line.rstrip(b'\n')
+            if not raw_line:
+                continue
+
+            n_dialogs += 1
+            keys, offsets = buffers[_EXACT]
+            keys.append(int.from_bytes(hashlib.blake2b(raw_line, digest_size=8).digest(), 'little'))
+            offsets.append(offset)
+
+            if self._near_duplicates:
+                keys, offsets = buffers[_NEAR]
+                band_keys = self._get_band_keys(json.loads(raw_line))
+                keys.extend(band_keys)
+                offsets.extend([offset] * len(band_keys))
+
+            if len(buffers[self._kinds[-1]][0]) >= _RECORDS_BUFFER_SIZE:
+                self._flush_records(shard_id, buffers)
+
+        self._flush_records(shard_id, buffers)
+
+        return n_dialogs
+
+    def _get_band_keys(self, dialog):
+        words = _WORD_PATTERN.findall(' '.join(dialog).lower())
+        if not words:
+            return []
+
+        n_shingles = max(len(words) - self._shingle_size + 1, 1)
+        shingles = {' '.join(words[i:i + self._shingle_size]) for i in range(n_shingles)}
+        shingle_hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'little')
+             for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles))
+
+        # Integer overflow is the intended mod 2^64 of the multiply-shift hashing:
+        with np.errstate(over='ignore'):
+            signature = (self._minhash_a[:, None] * shingle_hashes[None, :] + self._minhash_b[:, None]).min(axis=1)
+
+        bands = signature.reshape(self._n_bands, -1)
+        return [
+            int.from_bytes(hashlib.blake2b(band.tobytes(), digest_size=8, salt=bytes([i])).digest(), 'little')
+            for i, band in enumerate(bands)
+        ]
+
+    def _flush_records(self, shard_id, buffers):
+        for kind, (keys, offsets) in buffers.items():
+            if not keys:
+                continue
+
+            records = np.empty(len(keys), dtype=_RECORD_DTYPE)
+            records['key'] = keys
+            records['offset'] = offsets
+            partitions = records['key'] % np.uint64(self._n_partitions)
+            for partition in np.unique(partitions):
+                file_path = self._get_records_file_path(kind, shard_id, int(partition))
+                with open(file_path, 'ab') as file:
+                    records[partitions == partition].tofile(file)
+
+            keys.clear()
+            offsets.clear()
+
+    def _find_partition_duplicates(self, kind_and_partition):
+        kind, partition = kind_and_partition
+        file_paths = [self._get_records_file_path(kind, shard_id, partition) for shard_id in range(self._n_shards)]
+        records = [np.fromfile(file_path, dtype=_RECORD_DTYPE) for file_path in file_paths if file_path.exists()]
+        records = np.concatenate(records) if records else np.empty(0, dtype=_RECORD_DTYPE)
+
+        # Sorted by key and then by offset, so the first record of each key is its first occurrence:
+        records.sort(order=('key', 'offset'))
+        is_duplicate = np.zeros(len(records), dtype=bool)
+        is_duplicate[1:] = records['key'][1:] == records['key'][:-1]
+        duplicate_offsets = np.unique(records['offset'][is_duplicate])
+        np.save(self._get_duplicates_file_path(kind, partition), duplicate_offsets)
+
+        for file_path in file_paths:
+            if file_path.exists():
+                os.remove(file_path)
+
+        return kind, len(duplicate_offsets)
+
+    def _write_shard(self, shard_id):
+        duplicate_offsets = self._get_shard_duplicate_offsets(shard_id)
+        lines = iterate_on_file_shard_lines(self._file_path, num_shards=self._n_shards, shard_id=shard_id)
+        n_dialogs_kept = 0
+
+        with open(self._get_shard_file_path(shard_id), 'wb') as out_file:
+            for offset, raw_line in lines:
+                if not raw_line.strip() or offset in duplicate_offsets:
+                    continue
+
+                if not raw_line.endswith(b'\n'):
+                    raw_line += b'\n'
+                out_file.write(raw_line)
+                n_dialogs_kept += 1
+
+        return n_dialogs_kept
+
+    def _get_shard_duplicate_offsets(self, shard_id):
+        shard_range = get_shard_range(os.path.getsize(self._file_path), num_shards=self._n_shards, shard_id=shard_id)
+        duplicate_offsets = set()
+        for kind in self._kinds:
+            for partition in range(self._n_partitions):
+                offsets = np.load(self._get_duplicates_file_path(kind, partition))
+                start, end = np.searchsorted(offsets, shard_range)
+                duplicate_offsets.update(offsets[start:end].tolist())
+
+        return duplicate_offsets
+
+    def _merge_shard_files(self):
+        merge_files([self._get_shard_file_path(shard_id) for shard_id in range(self._n_shards)], self._out_file_path)
+
+    def _get_records_file_path(self, kind, shard_id, partition):
+        return self._work_dir / f'{kind}-{shard_id:05d}-{partition:05d}.bin'
+
+    def _get_duplicates_file_path(self, kind, partition):
+        return self._work_dir / f'{kind}-duplicates-{partition:05d}.npy'
+
+    def _get_shard_file_path(self, shard_id):
+        return self._work_dir / f'shard-{shard_id:05d}.jsonl'
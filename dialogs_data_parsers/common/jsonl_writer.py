@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+
+from dialogs_data_parsers.utils import truncate_partial_last_record
+
+_logger = logging.getLogger(__name__)
+_STOP = object()
+
+
+class AsyncJsonlWriter:
+    """Single writer of the jsonl file for many concurrent coroutines.
+
+    Records are put to a bounded queue and written by one writer task which keeps the file open. Records are written
+    in batches: a batch is written when it reaches `batch_size` records or when `flush_interval` seconds passed since
+    its first record. Each batch is written by one write call of complete lines, flushed and fsync-ed, so it's a
+    checkpoint: after it `on_batch_written` callback is called. If the file ends with a partially written line (e.g.
+    after a crash), this line is truncated on open, so the readers never see a torn line.
+
+    If a batch write (or the callback) fails, the writer keeps discarding the queued records, so the producers
+    never hang on the full queue: their writes raise `RuntimeError` and the error itself is re-raised on exit (if the
+    body has raised its own exception, it's propagated with the writer error in its context).
+
+    Usage:
+        async with AsyncJsonlWriter(file_path) as writer:
+            await writer.write(record)
+    """
+
+    def __init__(self, file_path, batch_size=100, flush_interval=5.0, queue_size=1000, on_batch_written=None):
+        """
+        :param on_batch_written: Optional callable which takes a list of (record, offset, length) tuples of the
+            records which were durably written.
+        """
+        self._file_path = Path(file_path)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue_size = queue_size
+        self._on_batch_written = on_batch_written
+
+        self._queue = None
+        self._file = None
+        self._writer_task = None
+        self._error = None
+
+    async def __aenter__(self):
+        self._file_path.parent.mkdir(exist_ok=True, parents=True)
+        truncate_partial_last_record(self._file_path)
+        self._file = open(self._file_path, 'ab')
+
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._writer_task = asyncio.ensure_future(self._run_writer())
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if not self._writer_task.done():
+                await self._queue.put(_STOP)
+            await self._writer_task
+        finally:
+            self._file.close()
+
+        if self._error is None:
+            return
+        elif exc_type is None:
+            raise self._error
+        elif exc_val.__cause__ is self._error:
+            # The body has failed on the write, so the writer error is already chained.
+            return
+        elif exc_val.__context__ is None:
+            # The body's exception is not masked by the writer error, but chained to it:
+            exc_val.__context__ = self._error
+        else:
+            _logger.error(f'Writer has failed: {self._file_path}', exc_info=self._error)
+
+    async def write(self, record):
+        self._check_writer()
+        await self._queue.put(record)
+        # The record is discarded, if the writer has failed while the producer was waiting on the full queue:
+        self._check_writer()
+
+    def _check_writer(self):
+        if self._error is not None:
+            raise RuntimeError(f'Writer has failed: {self._file_path}') from self._error
+        elif self._writer_task.done():
+            raise RuntimeError('Writer is closed')
+
+    async def _run_writer(self):
+        loop = asyncio.get_event_loop()
+        is_stopped = False
+        while not is_stopped:
+            batch = []
+            record = await self._queue.get()
+            deadline = loop.time() + self._flush_interval
+
+            while record is not _STOP:
+                batch.append(record)
+                if len(batch) >= self._batch_size:
+                    break
+
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                is_stopped = True
+
+            if batch:
+                try:
+                    records_offsets_lengths = await loop.run_in_executor(None, self._write_batch, batch)
+                    if self._on_batch_written is not None:
+                        self._on_batch_written(records_offsets_lengths)
+                except Exception as e:
+                    _logger.error(f'Failed to write records: {self._file_path}, {e!r}')
+                    self._error = e
+                    break
+
+        # After the failure, the producers, which wait on the full queue, are released until the stop:
+        while not is_stopped:
+            is_stopped = await self._queue.get() is _STOP
+
+    def _write_batch(self, batch):
+        lines = [(json.dumps(record, ensure_ascii=False) + '\n').encode() for record in batch]
+        offset = self._file.tell()
+
+        self._file.write(b''.join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        _logger.debug(f'{len(batch)} records written: {self._file_path}')
+
+        records_offsets_lengths = []
+        for record, line in zip(batch, lines):
+            records_offsets_lengths.append((record, offset, len(line)))
+            offset += len(line)
+
+        return records_offsets_lengths
+
@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from dialogs_data_parsers.utils import open_atomic, truncate_partial_last_record
+
+_logger = logging.getLogger(__name__)
+_REQUESTS_FILE_NAME = 'requests.jsonl'
+_BLOBS_DIR_NAME = 'blobs'
+
+
+class PageArchive:
+    """On-disk archive of the raw responses, which allows to re-run the pages parsing without the network.
+
+    Responses are stored as gzip blobs, which are named by the hash of their content (so identical pages, e.g. empty
+    comments pages, are stored once). Requests are recorded in the append-only `requests.jsonl` log, which maps the
+    request key (hash of the method, url, params and data) to its response blob. The log is loaded in memory, blobs
+    are read on demand. A partially written last log line (e.g. after a crash) is truncated on load.
+
+    Methods are thread-safe, so the blocking compression and file I/O can be run in the executor threads.
+    """
+
+    def __init__(self, archive_dir, compress_level=6):
+        self._archive_dir = Path(archive_dir)
+        self._blobs_dir = self._archive_dir / _BLOBS_DIR_NAME
+        self._requests_file_path = self._archive_dir / _REQUESTS_FILE_NAME
+        self._compress_level = compress_level
+        self._key_to_content_hash = {}
+
+        if self._requests_file_path.is_file():
+            self._load()
+
+        self._blobs_dir.mkdir(exist_ok=True, parents=True)
+        self._requests_file = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._key_to_content_hash)
+
+    def get(self, url, params=None, data=None, method='get'):
+        """Returns the archived response text of the request or None."""
+        content_hash = self._key_to_content_hash.get(get_request_key(url, params, data, method))
+        if content_hash is None:
+            return None
+
+        with gzip.open(self._get_blob_path(content_hash), 'rb') as file:
+            return file.read().decode()
+
+    def put(self, text, url, params=None, data=None, method='get'):
+        content = text.encode()
+        content_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+        blob_path = self._get_blob_path(content_hash)
+        if not blob_path.is_file():
+            blob_path.parent.mkdir(exist_ok=True)
+            with open_atomic(blob_path, 'wb') as file:
+                file.write(gzip.compress(content, compresslevel=self._compress_level))
+
+        key = get_request_key(url, params, data, method)
+        record = {'key': key, 'method': method, 'url': url, 'content': content_hash, 'time': time.time()}
+        with self._lock:
+            if self._key_to_content_hash.get(key) == content_hash:
+                return
+
+            self._key_to_content_hash[key] = content_hash
+            if self._requests_file is None:
+                self._requests_file = open(self._requests_file_path, 'a')
+
+            self._requests_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._requests_file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._requests_file is not None:
+                self._requests_file.close()
+                self._requests_file = None
+
+    def _load(self):
+        truncate_partial_last_record(self._requests_file_path)
+        with open(self._requests_file_path, 'rb') as file:
+            for line in file:
+                record = json.loads(line)
+                self._key_to_content_hash[record['key']] = record['content']
+
+        _logger.info(f'Page archive loaded: {self._archive_dir}, requests: {len(self._key_to_content_hash)}')
+
+    def _get_blob_path(self, content_hash):
+        return self._blobs_dir / content_hash[:2] / f'{content_hash}.gz'
+
+
+def get_request_key(url, params=None, data=None, method='get'):
+    """Returns the hash of the request, which doesn't depend on the order of the data dict keys."""
+    params = [list(param) for param in params] if params else None
+    request = json.dumps([method, url, params, data], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(request.encode(), digest_size=16).hexdigest()
@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import sys
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+from dialogs_data_parsers.utils import truncate_partial_last_record
+
+_logger = logging.getLogger(__name__)
+_HASH_SIZE = 8
+_BUFFER_SIZE = 1 << 16
+
+
+class PersistentHashSet:
+    """Set of strings which is stored as an append-only file of their 64-bit hashes.
+
+    Only hashes are kept in memory (see `CompactHashSet`), so the loading time and the memory footprint are
+    proportional to the number of elements, not to their length. A partially written last hash (e.g. after a crash)
+    is discarded on load.
+    """
+
+    def __init__(self, file_path):
+        self._file_path = Path(file_path)
+        self._hashes = CompactHashSet()
+
+        if self._file_path.is_file():
+            self._load()
+
+        self._file_path.parent.mkdir(exist_ok=True, parents=True)
+        self._file = open(self._file_path, 'ab')
+
+    def __contains__(self, value):
+        return get_hash(value) in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, value):
+        hash_ = get_hash(value)
+        if hash_ not in self._hashes:
+            self._hashes.add(hash_)
+            self._file.write(hash_.to_bytes(_HASH_SIZE, 'little'))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def _load(self):
+        truncate_partial_last_record(self._file_path, record_size=_HASH_SIZE)
+        hashes = array('Q')
+        hashes.frombytes(self._file_path.read_bytes())
+        if sys.byteorder != 'little':
+            hashes.byteswap()
+        self._hashes.update(np.frombuffer(hashes, dtype=np.uint64))
+
+
+class CompactHashSet:
+    """In-memory set of 64-bit hashes, which takes about 8 bytes per hash (a python set of ints takes ~70).
+
+    Hashes are kept in the sorted numpy array. New hashes are added to the small buffer set, which is merged into
+    the array when it's full, so the array is rebuilt once per `buffer_size` additions.
+    """
+
+    def __init__(self, buffer_size=_BUFFER_SIZE):
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._buffer = set()
+        self._buffer_size = buffer_size
+
+    def __contains__(self, hash_):
+        if hash_ in self._buffer:
+            return True
+
+        i = np.searchsorted(self._hashes, np.uint64(hash_))
+        return i < len(self._hashes) and self._hashes[i] == hash_
+
+    def __len__(self):
+        return len(self._hashes) + len(self._buffer)
+
+    def add(self, hash_):
+        if hash_ not in self:
+            self._buffer.add(hash_)
+            if len(self._buffer) >= self._buffer_size:
+                self._merge_buffer()
+
+    def update(self, hashes):
+        """Adds the array of hashes at once."""
+        self._merge_buffer()
+        hashes = np.unique(np.asarray(hashes, dtype=np.uint64))
+        self._hashes = np.union1d(self._hashes, hashes) if len(self._hashes) else hashes
+
+    def _merge_buffer(self):
+        if not self._buffer:
+            return
+
+        hashes = np.fromiter(self._buffer, dtype=np.uint64, count=len(self._buffer))
+        hashes.sort()
+        self._hashes = np.insert(self._hashes, np.searchsorted(self._hashes, hashes), hashes)
+        self._buffer.clear()
+
+
+def get_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=_HASH_SIZE).digest(), 'little')
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class AdaptiveConcurrencyLimiter:
+    """Limits the number of concurrent requests with the limit, which is adapted by AIMD (additive increase,
+    multiplicative decrease).
+
+    Each successful request increases the limit by 1 / limit (so, by 1 per limit of requests), up to
+    `max_concurrency`. An overload signal (429 / 5xx response, timeout, connection error) or a latency which is
+    `latency_tolerance` times higher than the best observed one decreases the limit by `decrease_factor`. Decreases
+    are not repeated within `decrease_cooldown` seconds, so a burst of errors from the same overload counts once.
+
+    Latency baseline is kept per request class (e.g. story pages and comments ajax), because the classes have very
+    different latencies, and a switch to the slower class is not an overload.
+
+    Usage:
+        async with limiter:
+            ...
+            limiter.on_success(latency, request_class)
+    """
+
+    def __init__(
+            self,
+            concurrency,
+            max_concurrency=None,
+            min_concurrency=1,
+            decrease_factor=0.5,
+            decrease_cooldown=1.0,
+            latency_tolerance=3.0,
+            latency_smoothing=0.1):
+        """
+        :param concurrency: Initial limit.
+        :param max_concurrency: Max limit. Defaults to `concurrency`, i.e. the limit is only decreased on overload and
+            then recovers back.
+        :param latency_tolerance: If None, latency is not taken into account.
+        :param latency_smoothing: Weight of the new latency in its exponential moving average.
+        """
+        self._max_concurrency = max_concurrency or concurrency
+        self._min_concurrency = min_concurrency
+        self._limit = float(min(concurrency, self._max_concurrency))
+        self._decrease_factor = decrease_factor
+        self._decrease_cooldown = decrease_cooldown
+        self._latency_tolerance = latency_tolerance
+        self._latency_smoothing = latency_smoothing
+
+        self._n_active = 0
+        self._condition = asyncio.Condition()
+        self._last_decrease_time = 0.0
+        # Request class -> [latency moving average, min latency moving average]:
+        self._class_to_latencies = {}
+        self._paused_until = 0.0
+
+    @property
+    def concurrency(self):
+        return int(self._limit)
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._n_active < int(self._limit))
+            self._n_active += 1
+
+        # Retry-After pause is shared by all requests:
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        async with self._condition:
+            self._n_active -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency, request_class=None):
+        """
+        :param latency: Request latency in seconds.
+        :param request_class: Hashable key of the requests with comparable latencies (e.g. endpoint). The latency
+            is compared only with the baseline of its class.
+        """
+        latencies = self._class_to_latencies.get(request_class)
+        if latencies is None:
+            latencies = self._class_to_latencies[request_class] = [latency, latency]
+        else:
+            latencies[0] += self._latency_smoothing * (latency - latencies[0])
+            latencies[1] = min(latencies[1], latencies[0])
+
+        if self._latency_tolerance is not None and latencies[0] > self._latency_tolerance * latencies[1]:
+            self._decrease(f'latency of {request_class}' if request_class is not None else 'latency')
+        else:
+            self._limit = min(self._limit + 1 / self._limit, self._max_concurrency)
+
+    def on_overload(self, reason):
+        self._decrease(reason)
+
+    def pause(self, delay):
+        """Holds all the new requests for `delay` seconds (e.g. on the Retry-After header)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self._last_decrease_time < self._decrease_cooldown:
+            return
+
+        self._last_decrease_time = now
+        self._limit = max(self._limit * self._decrease_factor, self._min_concurrency)
+        for latencies in self._class_to_latencies.values():
+            # Latency under the decreased load is yet to be observed:
+            latencies[0] = latencies[1]
+        _logger.info(f'Concurrency is decreased to {self.concurrency} ({reason})')
+
+
+class TokenBucket:
+    """Caps the rate of requests at `rate` per second with bursts up to `burst` requests."""
+
+    def __init__(self, rate, burst=None):
+        self._rate = rate
+        self._burst = burst or max(1.0, rate)
+        self._tokens = self._burst
+        self._updated_time = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated_time) * self._rate)
+                self._updated_time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self._rate)
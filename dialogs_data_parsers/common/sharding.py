@@ -0,0 +1,138 @@
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import traceback
+
+_logger = logging.getLogger(__name__)
+_DONE = 'done'
+_ERROR = 'error'
+_POLL_INTERVAL = 1.0
+
+
+def iterate_on_file_shard_lines(file_path, num_shards=1, shard_id=0):
+    """Yields (offset, raw_line) tuples of the lines which belong to the byte-range shard of the file.
+
+    The file is split on `num_shards` equal byte ranges. A line belongs to the shard, which range contains the
+    first byte of the line. So, shards never overlap and together they cover all the lines of the file.
+    """
+    start, end = get_shard_range(os.path.getsize(file_path), num_shards=num_shards, shard_id=shard_id)
+
+    with open(file_path, 'rb') as file:
+        if start > 0:
+            # Skip the line which started in the previous shard (if the previous byte is a newline, nothing is skipped).
+            file.seek(start - 1)
+            file.readline()
+
+        offset = file.tell()
+        while offset < end:
+            raw_line = file.readline()
+            if not raw_line:
+                break
+
+            yield offset, raw_line
+            offset += len(raw_line)
+
+
+def get_shard_range(n_items, num_shards=1, shard_id=0):
+    """Returns [start, end) range of the shard, if `n_items` are split on `num_shards` contiguous equal shards."""
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f'Shard id must be in [0, {num_shards}), got: {shard_id}')
+
+    return n_items * shard_id // num_shards, n_items * (shard_id + 1) // num_shards
+
+
+def get_worker_shard(num_shards=1, shard_id=0):
+    """Returns (num_shards, shard_id) which account for the PyTorch data loader worker (if any).
+
+    Inside a data loader worker process the shard is subdivided further between the loader workers, so each worker
+    iterates on its own part of the data.
+    """
+    try:
+        from torch.utils.data import get_worker_info
+    except ImportError:
+        return num_shards, shard_id
+
+    worker_info = get_worker_info()
+    if worker_info is None:
+        return num_shards, shard_id
+
+    return num_shards * worker_info.num_workers, shard_id * worker_info.num_workers + worker_info.id
+
+
+def iterate_in_processes(iterate_on_shard, num_shards, shard_ids, queue_size=64, batch_size=256):
+    """Runs `iterate_on_shard(num_shards, shard_id)` for each shard id in a separate process and yields the merged
+    samples. Samples are passed through a bounded queue in batches, so the fast producers are back-pressured by the
+    consumer. The order of samples between shards is not deterministic.
+
+    Worker processes are daemonic, so it can't be used inside a daemonic process, e.g. a PyTorch data loader worker
+    (use the loader workers instead, the shard is split between them, see `get_worker_shard`).
+
+    :param iterate_on_shard: Picklable callable which takes (num_shards, shard_id) and returns iterable of picklable
+        samples.
+    """
+    if multiprocessing.current_process().daemon:
+        raise RuntimeError(
+            'Multi-process iteration is not supported inside a daemonic process (e.g. PyTorch data loader worker), '
+            'use n_processes=1 there')
+
+    queue = multiprocessing.Queue(maxsize=queue_size)
+    processes = [
+        multiprocessing.Process(
+            target=_produce, args=(iterate_on_shard, num_shards, shard_id, queue, batch_size), daemon=True)
+        for shard_id in shard_ids
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        n_processes_done = 0
+        are_processes_exited = False
+        while n_processes_done < len(processes):
+            try:
+                # Workers report before the exit, so after all of them have exited, the reports are drained without
+                # waiting, and only then the missing reports are considered lost:
+                status, payload = queue.get_nowait() if are_processes_exited else queue.get(timeout=_POLL_INTERVAL)
+            except queue_module.Empty:
+                if are_processes_exited:
+                    raise RuntimeError('Worker processes exited without finishing the iteration')
+
+                _check_processes(processes)
+                are_processes_exited = not any(process.is_alive() for process in processes)
+                continue
+
+            if status == _DONE:
+                n_processes_done += 1
+            elif status == _ERROR:
+                raise RuntimeError(f'Shard iteration failed in the worker process:\n{payload}')
+            else:
+                yield from payload
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def _check_processes(processes):
+    """Raises, if a worker process died (e.g. killed by OOM), so the consumer doesn't wait for its report forever."""
+    for process in processes:
+        if process.exitcode:
+            raise RuntimeError(f'Worker process died with exit code {process.exitcode}')
+
+
+def _produce(iterate_on_shard, num_shards, shard_id, queue, batch_size):
+    try:
+        batch = []
+        for sample in iterate_on_shard(num_shards, shard_id):
+            batch.append(sample)
+            if len(batch) == batch_size:
+                queue.put((None, batch))
+                batch = []
+
+        if batch:
+            queue.put((None, batch))
+    except Exception:
+        queue.put((_ERROR, traceback.format_exc()))
+    else:
+        queue.put((_DONE, None))
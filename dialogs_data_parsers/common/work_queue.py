@@ -0,0 +1,44 @@
+import asyncio
+import logging
+
+_logger = logging.getLogger(__name__)
+_STOP = object()
+
+
+async def run_workers(items, worker, n_workers, queue_size=None):
+    """Processes items by a fixed number of worker tasks fed from a bounded queue.
+
+    Unlike gathering fixed-size batches, a slow item doesn't stall the start of the next ones: each worker takes a
+    new item as soon as it's done with the previous one. The items iterable is consumed lazily, the producer waits
+    while the queue is full.
+
+    :param items: Iterable (possibly lazy) of items to process.
+    :param worker: Coroutine function which takes one item.
+    :param n_workers: Number of concurrent worker tasks.
+    :param queue_size: Max number of items waiting in the queue. Defaults to `2 * n_workers`.
+    """
+    queue = asyncio.Queue(maxsize=queue_size or 2 * n_workers)
+
+    async def _consume():
+        while True:
+            item = await queue.get()
+            if item is _STOP:
+                return
+
+            try:
+                await worker(item)
+            except Exception:
+                _logger.exception(f'Worker failed on item: {item}')
+
+    consumers = [asyncio.ensure_future(_consume()) for _ in range(n_workers)]
+    try:
+        for item in items:
+            await queue.put(item)
+
+        for _ in consumers:
+            await queue.put(_STOP)
+
+        await asyncio.gather(*consumers)
+    finally:
+        for consumer in consumers:
+            consumer.cancel()
@@ -1,10 +1,20 @@
 import json
-import random
+import logging
+import math
+import multiprocessing
+import os
 import re
-from itertools import chain, cycle
+from contextlib import nullcontext
+from itertools import chain, cycle, islice
 from pathlib import Path
 
+import numpy as np
+
+from dialogs_data_parsers.common.sharding import iterate_on_file_shard_lines
 from dialogs_data_parsers.flibusta.dialogs_parser import DIALOG_SEPARATORS
+from dialogs_data_parsers.utils import merge_files
+
+_logger = logging.getLogger(__name__)
 
 _PERSON_FLAG = 0
 _AUTHOR_FLAG = 1
@@ -14,48 +24,180 @@ _SPLIT_FLAGS = (_PERSON_FLAG, _PUNCT_FLAG, _DASH_FLAG, _AUTHOR_FLAG, _PUNCT_FLAG
 
 _DIALOGS_SEPARATORS_SET = set(DIALOG_SEPARATORS)
 _AUTHOR_WORDS_SEPARATOR_PATTERN = re.compile(f'([.,!?:;]+)(\s?[{DIALOG_SEPARATORS}])')
-_AUGMENT_PUNCT_CHOICES = list(set(chain(*[[symbol * i for i in range(0, 4)] for symbol in '.,!?:; '])))
-_AUGMENT_DASH_CHOICES = list(
+# Choices are sorted, so the augmentations don't depend on the strings hash randomization:
+_AUGMENT_PUNCT_CHOICES = sorted(set(chain(*[[symbol * i for i in range(0, 4)] for symbol in '.,!?:; '])))
+_AUGMENT_DASH_CHOICES = sorted(
     set(chain(*[[' ' * i + symbol for i in range(0, 4)] for symbol in list(_DIALOGS_SEPARATORS_SET) + [' ']])))
+_SAMPLINGS = ('head', 'reservoir')
+_SEPARATOR_PATTERN = re.compile(f'[{DIALOG_SEPARATORS}]')
+_RANDOM_BATCH_SIZE = 1 << 14
+_MAX_LENGTH_STRATUM = 10
+_QUOTA_OVER_ALLOCATION = 1.25
+_SAMPLE_SUFFIX = '.sample'
+_SAMPLING_STREAM_ID = 1
 
 
 class FlibustaAuthorWordsAnnotationGenerator:
-    def __init__(self, raw_dialogs_file_path, out_file_path, n_samples, augment_p):
+    def __init__(
+            self,
+            raw_dialogs_file_path,
+            out_file_path,
+            n_samples,
+            augment_p,
+            n_shards=1,
+            n_workers=1,
+            seed=0,
+            sampling='head',
+            stratify_by=None,
+            skip_utterances_without_separators=False):
+        """
+        :param n_shards: Number of byte-range shards of the raw dialogs file. Each shard gives its equal part of the
+            samples, with its own random generator seeded by (seed, shard id). So the output depends only on the seed
+            and the number of shards, not on the number of workers. With the default single shard, the "head" sampling
+            takes the first utterances of the whole file (as the sequential generator did). Increase it to generate
+            the samples in parallel, but note that it changes the samples.
+        :param n_workers: Number of worker processes, which generate the shards (at most `n_shards` are busy). If 1,
+            the shards are generated in the current process.
+        :param sampling: "head" takes the first utterances of each shard. "reservoir" takes a uniform random sample of
+            the shard utterances in one pass (each worker keeps only its samples in memory).
+        :param stratify_by: Optional utterances strata for the "reservoir" sampling: "length" (log2 of the number of
+            characters) or "separators" (presence of the dialog separator). Shard samples are allocated between the
+            strata proportionally to their sizes (each worker keeps up to its samples number per stratum in memory).
+        :param skip_utterances_without_separators: Skip utterances without dialog separators (so without author words)
+            before the sampling.
+        """
+        if sampling not in _SAMPLINGS:
+            raise ValueError(f'Unknown sampling: {sampling}, choose one of: {list(_SAMPLINGS)}')
+        if stratify_by is not None and sampling != 'reservoir':
+            raise ValueError('Stratification is supported only with the "reservoir" sampling')
+        if stratify_by is not None and stratify_by not in _GET_STRATUM_FUNCTIONS:
+            raise ValueError(f'Unknown strata: {stratify_by}, choose one of: {list(_GET_STRATUM_FUNCTIONS)}')
+
         self._raw_dialogs_file_path = raw_dialogs_file_path
         self._augment_p = augment_p
         self._out_file_path = Path(out_file_path)
         self._n_samples = int(n_samples)
+        self._n_shards = n_shards
+        self._n_workers = n_workers
+        self._seed = seed
+        self._sampling = sampling
+        self._stratify_by = stratify_by
+        self._skip_utterances_without_separators = skip_utterances_without_separators
 
     def run(self):
-        utterances = self._iterate_on_utterances()
-        n_samples_done = 0
-
         self._out_file_path.parent.mkdir(exist_ok=True, parents=True)
 
-        with open(self._out_file_path, 'w') as out_file:
+        # Shards which are smaller than their quota are compensated by the bigger ones. So the shards are sampled with
+        # the over-allocated quotas, and then the final quotas are taken from their samples. Only if a shortfall
+        # exceeds the over-allocation, the bigger shards are sampled again with their final quotas (for the
+        # "reservoir" sampling the shard sizes are known after the first pass, so it happens at most once):
+        quota = math.ceil(self._n_samples / self._n_shards)
+        shard_sample_sizes = [min(math.ceil(quota * _QUOTA_OVER_ALLOCATION), self._n_samples)] * self._n_shards
+        shard_n_utterances = [0] * self._n_shards
+        shard_ids = range(self._n_shards)
+
+        with multiprocessing.Pool(processes=self._n_workers) if self._n_workers > 1 else nullcontext() as pool:
+            imap = pool.imap_unordered if pool is not None else map
+            while True:
+                tasks = [(shard_id, shard_sample_sizes[shard_id]) for shard_id in shard_ids]
+                for shard_id, n_utterances in imap(self._sample_shard, tasks):
+                    shard_n_utterances[shard_id] = n_utterances
+
+                shard_quotas = _get_shard_quotas(shard_n_utterances, self._n_samples)
+                shard_ids = [
+                    shard_id for shard_id in range(self._n_shards)
+                    if shard_sample_sizes[shard_id] < min(shard_quotas[shard_id], shard_n_utterances[shard_id])
+                ]
+                if not shard_ids:
+                    break
+
+                _logger.info(f'Shards are sampled again with the bigger quotas: {len(shard_ids)}')
+                for shard_id in shard_ids:
+                    shard_sample_sizes[shard_id] = shard_quotas[shard_id]
+
+            # Rounded up quotas may exceed the number of samples, so the last shards give less:
+            tasks = []
+            n_samples_left = self._n_samples
+            for shard_id, quota in enumerate(shard_quotas):
+                n_shard_samples = min(quota, shard_n_utterances[shard_id], n_samples_left)
+                tasks.append((shard_id, n_shard_samples))
+                n_samples_left -= n_shard_samples
+
+            n_samples_done = sum(imap(self._generate_shard, tasks))
+            _logger.info(f'Samples: {n_samples_done}/{self._n_samples}')
+
+        shard_file_paths = [self._get_shard_file_path(shard_id) for shard_id in range(self._n_shards)]
+        merge_files(shard_file_paths, self._out_file_path, remove=True)
+        if n_samples_done < self._n_samples:
+            _logger.warning(f'Raw dialogs file is exhausted, samples: {n_samples_done}/{self._n_samples}')
+
+        return n_samples_done
+
+    def _sample_shard(self, shard_id_and_sample_size):
+        """Saves up to `sample_size` (not augmented yet) utterances of the shard to the shard sample file and returns
+        (shard_id, number of the shard utterances). For the "head" sampling, the utterances are counted only up to
+        `sample_size + 1`, which is enough to tell if the shard is exhausted."""
+        shard_id, sample_size = shard_id_and_sample_size
+        utterances = self._iterate_on_utterances(shard_id)
+        if self._skip_utterances_without_separators:
+            utterances = filter(_SEPARATOR_PATTERN.search, utterances)
+
+        if self._sampling == 'reservoir':
+            # Sampling has its own random stream, so the augmentations don't depend on the sample size:
+            random_buffer = _RandomBuffer(np.random.default_rng([self._seed, shard_id, _SAMPLING_STREAM_ID]))
+            get_stratum = _GET_STRATUM_FUNCTIONS[self._stratify_by] if self._stratify_by else None
+            stratum_to_reservoir = _get_stratum_reservoirs(utterances, sample_size, get_stratum, random_buffer)
+            strata_samples = [[stratum, stratum_to_reservoir[stratum].n_items_seen, stratum_to_reservoir[stratum].items]
+                              for stratum in sorted(stratum_to_reservoir)]
+        else:
+            utterances = list(islice(utterances, sample_size + 1))
+            strata_samples = [[None, len(utterances), utterances[:sample_size]]]
+
+        # Sample is dumped at once, it's much faster than line by line:
+        with open(self._get_shard_file_path(shard_id, _SAMPLE_SUFFIX), 'w') as sample_file:
+            sample_file.write(json.dumps(strata_samples, ensure_ascii=False))
+
+        return shard_id, sum(stratum_size for _, stratum_size, _ in strata_samples)
+
+    def _generate_shard(self, shard_id_and_quota):
+        """Takes `quota` utterances from the shard sample, augments them and returns the number of samples."""
+        shard_id, quota = shard_id_and_quota
+        random_buffer = _RandomBuffer(np.random.default_rng([self._seed, shard_id]))
+        sample_file_path = self._get_shard_file_path(shard_id, _SAMPLE_SUFFIX)
+        with open(sample_file_path) as sample_file:
+            strata_samples = json.load(sample_file)
+        os.remove(sample_file_path)
+
+        if self._sampling == 'reservoir':
+            utterances = _get_stratified_sample(strata_samples, quota, random_buffer)
+        else:
+            _, _, utterances = strata_samples[0]
+            utterances = utterances[:quota]
+
+        with open(self._get_shard_file_path(shard_id), 'w') as out_file:
             for utterance in utterances:
-                augmented_split_utterance_and_flags = self._generate_augmented_split_utterance_and_flags(utterance)
-                if len(augmented_split_utterance_and_flags) == 0:
-                    continue
+                augmented_split_utterance_and_flags = self._generate_augmented_split_utterance_and_flags(
+                    utterance, random_buffer)
                 payload = json.dumps(augmented_split_utterance_and_flags, ensure_ascii=False)
                 out_file.write(payload)
                 out_file.write('\n')
-                n_samples_done += 1
 
-                if n_samples_done == self._n_samples:
-                    break
+        return len(utterances)
 
-                if n_samples_done % 10000 == 0:
-                    print(f'Samples: {n_samples_done}/{self._n_samples}')
+    def _get_shard_file_path(self, shard_id, suffix=''):
+        file_name = f'{self._out_file_path.stem}.part-{shard_id:05d}{suffix}{self._out_file_path.suffix}'
+        return self._out_file_path.with_name(file_name)
 
-    def _iterate_on_utterances(self):
-        with open(self._raw_dialogs_file_path) as file:
-            for line in file:
-                dialog = json.loads(line)
-                for utterance in dialog:
+    def _iterate_on_utterances(self, shard_id):
+        lines = iterate_on_file_shard_lines(self._raw_dialogs_file_path, num_shards=self._n_shards, shard_id=shard_id)
+        for _, line in lines:
+            dialog = json.loads(line)
+            for utterance in dialog:
+                # Empty utterances give empty samples:
+                if utterance:
                     yield utterance
 
-    def _generate_augmented_split_utterance_and_flags(self, utterance):
+    def _generate_augmented_split_utterance_and_flags(self, utterance, random_buffer):
         split_utterance = _AUTHOR_WORDS_SEPARATOR_PATTERN.split(utterance)
         split_utterance = [utterance for utterance in split_utterance if len(utterance)]
 
@@ -67,12 +209,137 @@ class FlibustaAuthorWordsAnnotationGenerator:
                 augmented_split_utterance.append(sub_utterance)
                 augmented_split_utterance_flags.append(flag)
             else:
-                if random.random() <= self._augment_p:
+                if random_buffer.random() <= self._augment_p:
                     choices = _AUGMENT_PUNCT_CHOICES if flag == _PUNCT_FLAG else _AUGMENT_DASH_CHOICES
-                    sub_utterance = random.choice(choices)
+                    sub_utterance = choices[int(random_buffer.random() * len(choices))]
 
                 augmented_split_utterance[-1] += sub_utterance
 
         augmented_split_utterance_and_flags = list(zip(augmented_split_utterance, augmented_split_utterance_flags))
 
         return augmented_split_utterance_and_flags
+
+
+class _RandomBuffer:
+    """Uniform [0, 1) random numbers, which are drawn from the generator in batches."""
+
+    def __init__(self, generator):
+        self._generator = generator
+        self._values = []
+
+    def random(self):
+        if not self._values:
+            self._values = self._generator.random(_RANDOM_BATCH_SIZE).tolist()
+            self._values.reverse()
+
+        return self._values.pop()
+
+
+class _Reservoir:
+    """Uniform random sample of the fixed size from the stream (Li's "Algorithm L", which draws random numbers only
+    for the items which get into the reservoir)."""
+
+    def __init__(self, size, random_buffer):
+        self.items = []
+        self.n_items_seen = 0
+        self._size = size
+        self._random_buffer = random_buffer
+        self._w = 1.0
+        self._next_index = size
+
+    def add(self, item):
+        if self.n_items_seen < self._size:
+            self.items.append(item)
+            if len(self.items) == self._size:
+                self._w = math.exp(math.log(self._random()) / self._size)
+                self._next_index = self._get_next_index()
+        elif self.n_items_seen == self._next_index:
+            self.items[int(self._random_buffer.random() * self._size)] = item
+            self._w *= math.exp(math.log(self._random()) / self._size)
+            self._next_index = self._get_next_index()
+
+        self.n_items_seen += 1
+
+    def _get_next_index(self):
+        if self._w >= 1.0:
+            return math.inf
+        return self.n_items_seen + int(math.log(self._random()) / math.log(1 - self._w)) + 1
+
+    def _random(self):
+        # (0, 1] interval, so the log is defined:
+        return 1.0 - self._random_buffer.random()
+
+
+def _get_stratum_reservoirs(items, size, get_stratum, random_buffer):
+    """Returns dict of the items strata (or None, if `get_stratum` is not set) to their reservoirs of `size`."""
+    stratum_to_reservoir = {}
+    for item in items:
+        stratum = get_stratum(item) if get_stratum else None
+        reservoir = stratum_to_reservoir.get(stratum)
+        if reservoir is None:
+            reservoir = stratum_to_reservoir[stratum] = _Reservoir(size, random_buffer)
+        reservoir.add(item)
+
+    return stratum_to_reservoir
+
+
+def _get_stratified_sample(strata_samples, size, random_buffer):
+    """Returns random sample of the items, which is allocated between the strata proportionally to their sizes.
+
+    :param strata_samples: List of (stratum, number of all stratum items, uniform random sample of the stratum items)
+        tuples. Stratum samples (e.g. reservoirs) must not be smaller than the stratum allocations: a random subset of
+        a uniform sample is a uniform sample too.
+    """
+    stratum_sizes = [stratum_size for _, stratum_size, _ in strata_samples]
+
+    sample = []
+    allocations = _get_proportional_allocation(stratum_sizes, min(size, sum(stratum_sizes)))
+    for (_, _, stratum_sample), allocation in zip(strata_samples, allocations):
+        # Partial Fisher-Yates shuffle, since the first items of the reservoir are not shuffled:
+        for i in range(allocation):
+            j = i + int(random_buffer.random() * (len(stratum_sample) - i))
+            stratum_sample[i], stratum_sample[j] = stratum_sample[j], stratum_sample[i]
+        sample.extend(stratum_sample[:allocation])
+
+    return sample
+
+
+def _get_shard_quotas(shard_sizes, n_samples):
+    """Splits `n_samples` on equal shard quotas, the shortfall of the smaller shards is split equally between the
+    bigger ones (repeatedly, until the quotas are filled or all the shards are exhausted). Quotas of the exhausted
+    shards may exceed their sizes."""
+    quotas = [math.ceil(n_samples / len(shard_sizes))] * len(shard_sizes)
+    while True:
+        n_samples_left = n_samples - sum(map(min, quotas, shard_sizes))
+        shard_ids = [shard_id for shard_id, size in enumerate(shard_sizes) if size > quotas[shard_id]]
+        if n_samples_left <= 0 or not shard_ids:
+            return quotas
+
+        for shard_id in shard_ids:
+            quotas[shard_id] += math.ceil(n_samples_left / len(shard_ids))
+
+
+def _get_proportional_allocation(sizes, n):
+    """Splits `n` on parts proportional to `sizes` by the largest remainder method."""
+    total_size = sum(sizes)
+    if not total_size:
+        return [0] * len(sizes)
+
+    quotas = [n * size / total_size for size in sizes]
+    allocation = [int(quota) for quota in quotas]
+    remainders = sorted(range(len(sizes)), key=lambda i: allocation[i] - quotas[i])
+    for i in remainders[:n - sum(allocation)]:
+        allocation[i] += 1
+
+    return allocation
+
+
+def _get_length_stratum(utterance):
+    return min(len(utterance).bit_length(), _MAX_LENGTH_STRATUM)
+
+
+def _has_separator(utterance):
+    return _SEPARATOR_PATTERN.search(utterance) is not None
+
+
+_GET_STRATUM_FUNCTIONS = {'length': _get_length_stratum, 'separators': _has_separator}
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import unicodedata
+import xml.etree.ElementTree as ET
+from collections import Counter, namedtuple
+from pathlib import Path
+from zipfile import BadZipFile, ZipFile
+
+from dialogs_data_parsers.flibusta.book_text_extractors import BOOK_LANG, iterate_on_fb2_text_chunks
+from dialogs_data_parsers.utils import get_file_fingerprint, get_xml_local_tag_name, open_atomic
+
+_logger = logging.getLogger(__name__)
+
+_HEADER_CHUNK_SIZE = 1 << 14
+_MAX_HEADER_SIZE = 1 << 20
+# Index of the previous version (with the other books keys) is rebuilt:
+_INDEX_VERSION = 2
+_AUTHOR_NAME_TAGS = ('last-name', 'first-name', 'middle-name', 'nickname')
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+BookHeader = namedtuple('BookHeader', ('lang', 'authors', 'title', 'document_id'))
+
+
+class FlibustaBookIndex:
+    """Persistent index of the books identities across all flibusta archives.
+
+    Book identities are read by the header-only pre-pass (see `read_book_header`), which decompresses only the fb2
+    `<description>` block. The index is a json file, which keeps the identities of each archive together with the
+    archive size and mtime, so on the next run only new (or changed) archives are pre-passed.
+
+    A book is a duplicate if its `<document-info><id>` or its `<title-info>` authors and title have already been seen
+    in a previous book. Books are ordered by the archives indexing order (new archives go after the already indexed
+    ones), and then by the zip order. So the resumed runs keep the books, which were kept before.
+    """
+
+    def __init__(self, index_file_path):
+        self._index_file_path = Path(index_file_path)
+        self._archives = self._load()
+
+    def update(self, archive_paths, n_workers=None):
+        """Pre-passes the archives, which are new or changed since the last update, and saves the index."""
+        archive_paths = [
+            path for path in sorted(archive_paths, key=lambda path: path.name)
+            if self._archives.get(path.name, {}).get('fingerprint') != get_file_fingerprint(path)
+        ]
+        if not archive_paths:
+            return
+
+        _logger.info(f'Indexing books headers of {len(archive_paths)} archives')
+        with multiprocessing.Pool(processes=n_workers or os.cpu_count()) as pool:
+            for archive_path, books in zip(archive_paths, pool.imap(_get_archive_books, archive_paths)):
+                # Changed archive is moved to the end, as it's indexed anew:
+                self._archives.pop(archive_path.name, None)
+                self._archives[archive_path.name] = {
+                    'fingerprint': get_file_fingerprint(archive_path),
+                    'books': books,
+                }
+
+        self._save()
+
+    def get_archives_books_to_parse(self, archive_names):
+        """Returns (archive name -> list of file names to parse, books counter) for the indexed archives.
+
+        Only the given (present) archives are taken into account, so the books of the removed archives are not
+        duplicates anymore. Counter keys are: "n_books", "n_non_ru_books", "n_duplicate_books".
+        """
+        archive_names = set(archive_names)
+        archive_to_file_names = {}
+        counter = Counter()
+        seen_keys = set()
+
+        for archive_name, archive in self._archives.items():
+            if archive_name not in archive_names:
+                continue
+
+            file_names = archive_to_file_names[archive_name] = []
+            for file_name, lang, keys in archive['books']:
+                counter['n_books'] += 1
+                if lang is not None and lang != BOOK_LANG:
+                    counter['n_non_ru_books'] += 1
+                elif any(key in seen_keys for key in keys):
+                    counter['n_duplicate_books'] += 1
+                else:
+                    seen_keys.update(keys)
+                    file_names.append(file_name)
+
+        return archive_to_file_names, counter
+
+    def _load(self):
+        if not self._index_file_path.is_file():
+            return {}
+
+        with open(self._index_file_path) as file:
+            index = json.load(file)
+
+        if index.get('version') != _INDEX_VERSION:
+            _logger.info(f'Books index of the previous version is rebuilt: {self._index_file_path}')
+            return {}
+
+        return index['archives']
+
+    def _save(self):
+        with open_atomic(self._index_file_path) as file:
+            json.dump({'version': _INDEX_VERSION, 'archives': self._archives}, file, ensure_ascii=False)
+
+
+def read_book_header(raw_fb2_file):
+    """Reads the fb2 `<description>` block from the binary file object and returns `BookHeader` (or None if the
+    header is malformed). The rest of the file is not read.
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    path = []
+    lang = None
+    title = None
+    document_id = None
+    authors = []
+    n_chars_read = 0
+
+    try:
+        for text in iterate_on_fb2_text_chunks(raw_fb2_file, chunk_size=_HEADER_CHUNK_SIZE):
+            if n_chars_read >= _MAX_HEADER_SIZE:
+                return None
+
+            n_chars_read += len(text)
+            parser.feed(text)
+            for event, element in parser.read_events():
+                tag = get_xml_local_tag_name(element.tag)
+                if event == 'start':
+                    path.append(tag)
+                    continue
+
+                path.pop()
+                parent_tag = path[-1] if path else None
+                if tag == 'lang' and lang is None:
+                    lang = (element.text or '').lower().strip()
+                elif tag == 'book-title' and parent_tag == 'title-info' and title is None:
+                    title = _normalize_text(''.join(element.itertext()))
+                elif tag == 'id' and parent_tag == 'document-info' and document_id is None:
+                    # Authors have their own (optional) <id>, so only the document one is taken:
+                    document_id = (element.text or '').strip() or None
+                elif tag == 'author' and parent_tag == 'title-info':
+                    authors.append(_get_author_name(element))
+                elif tag == 'description':
+                    return BookHeader(lang or '', sorted(filter(None, authors)), title, document_id)
+    except ET.ParseError:
+        return None
+
+    return None
+
+
+def get_book_keys(header):
+    """Returns identity keys of the book: hashes of its document id and of its authors and title. Books without
+    authors have no authors and title key, otherwise the anonymous books with the generic titles (e.g.
+    "Стихотворения") would be duplicates of each other."""
+    keys = []
+    if header.document_id:
+        keys.append(_get_key('id', header.document_id))
+    if header.title and header.authors:
+        keys.append(_get_key('work', '|'.join(header.authors + [header.title])))
+
+    return keys
+
+
+def _get_archive_books(archive_path):
+    books = []
+    try:
+        with ZipFile(archive_path, 'r') as zip_file:
+            for file_name in zip_file.namelist():
+                with zip_file.open(file_name) as raw_fb2_file:
+                    header = read_book_header(raw_fb2_file)
+
+                # Malformed headers (None lang) are left to the book lines extractor:
+                lang = header.lang if header else None
+                keys = get_book_keys(header) if header else []
+                books.append([file_name, lang, keys])
+    except BadZipFile:
+        _logger.warning(f'Bad zip file: {archive_path}')
+
+    return books
+
+
+def _get_author_name(element):
+    names = {}
+    for child in element:
+        tag = get_xml_local_tag_name(child.tag)
+        if tag in _AUTHOR_NAME_TAGS:
+            names[tag] = _normalize_text(child.text or '')
+
+    return ' '.join(filter(None, (names.get(tag) for tag in _AUTHOR_NAME_TAGS)))
+
+
+def _normalize_text(text):
+    text = unicodedata.normalize('NFKC', text).lower().replace('ё', 'е')
+    return _WHITESPACE_PATTERN.sub(' ', text).strip()
+
+
+def _get_key(kind, value):
+    return f'{kind}:{hashlib.blake2b(value.encode(), digest_size=8).hexdigest()}'
@@ -0,0 +1,185 @@
+import codecs
+import io
+import logging
+import re
+import xml.etree.ElementTree as ET
+from itertools import chain, islice
+
+import bs4
+
+from dialogs_data_parsers.utils import get_xml_local_tag_name
+
+_logger = logging.getLogger(__name__)
+
+BOOK_LANG = 'ru'
+_FEED_CHUNK_SIZE = 1 << 16
+_NON_EMPTY_LINE_PATTERN = re.compile('[^\n]+')
+_XML_PROLOG_ENCODING_PATTERN = re.compile(rb'\s*<\?xml[^>]*?encoding\s*=\s*["\']([\w.:-]+)["\']')
+_DEFAULT_ENCODING = 'utf-8'
+_BOM_ENCODINGS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+
+
+def iterate_on_book_lines_bs4(raw_fb2, counter=None):
+    """Reference extractor: builds the whole bs4 tree and splits the book text on lines.
+
+    :param raw_fb2: Fb2 bytes or binary file object.
+    :param counter: Optional `Counter` of the extraction events (the bs4 extractor has none).
+    """
+    book_soup = bs4.BeautifulSoup(raw_fb2, features="html.parser")
+    lang_tag = book_soup.find('lang')
+
+    if lang_tag and lang_tag.text.lower().strip() == BOOK_LANG:
+        book_text = book_soup.text
+        yield from iterate_on_text_lines(book_text)
+
+
+def iterate_on_text_lines(text):
+    """Lazily yields non-empty lines of the text (same lines as `re.split('\\n+', text)` without the empty ones)."""
+    for match in _NON_EMPTY_LINE_PATTERN.finditer(text):
+        yield match.group()
+
+
+def iterate_on_book_lines_streaming(raw_fb2, counter=None):
+    """Incremental extractor: checks the <lang> tag from the <description> header first and skips the body of
+    non-ru books. Yields the lines of the book text in the document order (texts and tails of all elements), so the
+    output is the same as of the bs4 extractor.
+
+    Malformed books (e.g. with the html entities, which are undefined in xml) fall back to the bs4 extractor. If the
+    parse error happens after some lines are yielded, the rest of the book is taken from the bs4 extractor output
+    after the same number of lines.
+
+    :param raw_fb2: Fb2 bytes or binary file object (e.g. `ZipFile.open` stream), which is read and decoded by
+        chunks (see `iterate_on_fb2_text_chunks`). Lines are yielded after each parsed chunk and the parsed
+        elements are dropped from the tree, so the memory doesn't grow with the book size.
+    :param counter: Optional `Counter` of the extraction events: "n_fallback_books" (parse error before the first
+        line) and "n_late_fallback_books" (parse error after the first lines).
+    """
+    if isinstance(raw_fb2, bytes):
+        raw_fb2 = io.BytesIO(raw_fb2)
+
+    n_lines = 0
+    try:
+        for line in _iterate_on_book_lines_streaming(raw_fb2):
+            yield line
+            n_lines += 1
+    except ET.ParseError as e:
+        if n_lines:
+            _logger.warning(f'Fb2 parse error after {n_lines} lines, the rest is taken from the bs4 extractor: {e}')
+        else:
+            _logger.debug(f'Falling back to bs4 extractor, fb2 parse error: {e}')
+
+        if counter is not None:
+            counter['n_late_fallback_books' if n_lines else 'n_fallback_books'] += 1
+
+        raw_fb2.seek(0)
+        yield from islice(iterate_on_book_lines_bs4(raw_fb2.read()), n_lines, None)
+
+
+def iterate_on_fb2_text_chunks(raw_fb2_file, chunk_size=_FEED_CHUNK_SIZE):
+    """Lazily decodes the binary fb2 file by chunks.
+
+    The charset is taken from the BOM or from the XML prolog encoding (fb2 books are often in windows-1251), utf-8
+    by default. Undecodable bytes are replaced, so they don't break the XML parsing of the whole book.
+    """
+    chunk = raw_fb2_file.read(chunk_size)
+    decoder = codecs.getincrementaldecoder(_get_fb2_encoding(chunk))(errors='replace')
+
+    while chunk:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+        chunk = raw_fb2_file.read(chunk_size)
+
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def _get_fb2_encoding(head):
+    for bom, encoding in _BOM_ENCODINGS:
+        if head.startswith(bom):
+            return encoding
+
+    match = _XML_PROLOG_ENCODING_PATTERN.match(head)
+    if match is None:
+        return _DEFAULT_ENCODING
+
+    encoding = match.group(1).decode('ascii')
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        _logger.debug(f'Unknown fb2 encoding: {encoding}, {_DEFAULT_ENCODING} is used')
+        return _DEFAULT_ENCODING
+
+
+def _iterate_on_book_lines_streaming(raw_fb2_file):
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    lang = None
+    is_description_done = False
+    # Open elements with their last started child. Element text is complete on its first child start (or on its end)
+    # and element tail is complete on its next sibling start (or on its parent end), so the text pieces are taken in
+    # the document order and the finished children are dropped right after their tails are taken:
+    open_elements = []
+    text_pieces = []
+    last_line = ''
+    lines = []
+    tag_to_local_name = {}
+
+    for text in chain(iterate_on_fb2_text_chunks(raw_fb2_file), [None]):
+        if text is None:
+            # Raises the parse error of the truncated book:
+            parser.close()
+        else:
+            parser.feed(text)
+
+        for event, element in parser.read_events():
+            if event == 'start':
+                if open_elements:
+                    parent_and_last_child = open_elements[-1]
+                    parent, last_child = parent_and_last_child
+                    text_pieces.append(parent.text if last_child is None else _drop_element(last_child, parent))
+                    parent_and_last_child[1] = element
+                open_elements.append([element, None])
+                continue
+
+            _, last_child = open_elements.pop()
+            text_pieces.append(element.text if last_child is None else _drop_element(last_child, element))
+
+            tag = tag_to_local_name.get(element.tag)
+            if tag is None:
+                tag = tag_to_local_name[element.tag] = get_xml_local_tag_name(element.tag)
+
+            if tag == 'lang' and lang is None:
+                lang = (element.text or '').lower().strip()
+            elif tag == 'description':
+                is_description_done = True
+
+        if text_pieces:
+            *complete_lines, last_line = (last_line + ''.join(filter(None, text_pieces))).split('\n')
+            lines.extend(line for line in complete_lines if line)
+            text_pieces.clear()
+
+        if lang == BOOK_LANG:
+            yield from lines
+            lines.clear()
+        elif lang is not None or is_description_done:
+            return
+
+    if lang == BOOK_LANG and last_line:
+        yield last_line
+
+
+def _drop_element(element, parent):
+    """Drops the finished element from the tree and returns its tail."""
+    tail = element.tail
+    element.clear()
+    # Previous siblings are dropped already, so the element is the first child of its parent:
+    parent.remove(element)
+
+    return tail
+
+
+BOOK_LINES_EXTRACTORS = {
+    'bs4': iterate_on_book_lines_bs4,
+    'streaming': iterate_on_book_lines_streaming,
+}
@@ -0,0 +1,87 @@
+import json
+import logging
+from array import array
+from pathlib import Path
+
+from dialogs_data_parsers.common.columnar import StringColumn, StringColumnWriter, load_array, save_array
+
+_logger = logging.getLogger(__name__)
+_UTTERANCES = 'utterances'
+_DIALOG_OFFSETS = 'dialog_offsets'
+_LINE_OFFSETS = 'line_offsets'
+
+
+def export_flibusta_dialogs(dialogs_file_path, out_dir, logging_period=100000):
+    """Converts flibusta dialogs jsonl file to the columnar format, which is read by `FlibustaColumnarDialogs`.
+
+    Columns:
+        - utterances: strings column of all utterances of all dialogs;
+        - dialog_offsets: index of the first utterance of each dialog (plus the total number of utterances);
+        - line_offsets: byte offset of each dialog line in the source jsonl file (it's the dialog id of references).
+
+    :return: Number of exported dialogs.
+    """
+    out_dir = Path(out_dir)
+    utterances = StringColumnWriter(out_dir, _UTTERANCES)
+    dialog_offsets = array('q', [0])
+    line_offsets = array('q')
+
+    with open(dialogs_file_path, 'rb') as file:
+        offset = 0
+        for raw_line in file:
+            for utterance in json.loads(raw_line):
+                utterances.append(utterance)
+
+            dialog_offsets.append(len(utterances))
+            line_offsets.append(offset)
+            offset += len(raw_line)
+
+            if logging_period and len(line_offsets) % logging_period == 0:
+                _logger.info(f'Flibusta dialogs exported: {len(line_offsets)}')
+
+    utterances.close()
+    save_array(out_dir, _DIALOG_OFFSETS, dialog_offsets)
+    save_array(out_dir, _LINE_OFFSETS, line_offsets)
+
+    return len(line_offsets)
+
+
+class FlibustaColumnarDialogs:
+    """Memory-mapped dialogs exported by `export_flibusta_dialogs`."""
+
+    def __init__(self, dir_path):
+        self._utterances = StringColumn(dir_path, _UTTERANCES)
+        self._dialog_offsets = load_array(dir_path, _DIALOG_OFFSETS)
+        self._line_offsets = load_array(dir_path, _LINE_OFFSETS)
+
+    def __len__(self):
+        return len(self._line_offsets)
+
+    def iterate(self, start=0, end=None, chunk_size=10000):
+        """Yields (dialog_id, utterances) tuples of the dialogs with indexes in [start, end)."""
+        end = len(self) if end is None else end
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            dialog_offsets = self._dialog_offsets[chunk_start:chunk_end + 1].tolist()
+            line_offsets = self._line_offsets[chunk_start:chunk_end].tolist()
+            utterances = self._utterances.get_range(dialog_offsets[0], dialog_offsets[-1])
+            first_offset = dialog_offsets[0]
+
+            for i, dialog_id in enumerate(line_offsets):
+                yield dialog_id, utterances[dialog_offsets[i] - first_offset:dialog_offsets[i + 1] - first_offset]
+
+    def iterate_lengths(self, start=0, end=None):
+        """Yields (dialog_id, n_utterances) tuples of the dialogs with indexes in [start, end) without decoding them."""
+        end = len(self) if end is None else end
+        dialog_offsets = self._dialog_offsets[start:end + 1]
+        n_utterances = (dialog_offsets[1:] - dialog_offsets[:-1]).tolist()
+        yield from zip(self._line_offsets[start:end].tolist(), n_utterances)
+
+    def close(self):
+        self._utterances.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
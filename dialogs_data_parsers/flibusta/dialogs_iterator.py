@@ -1,24 +1,82 @@
 import json
 import logging
+from pathlib import Path
+
+from dialogs_data_parsers.common.sharding import get_shard_range, \
+    get_worker_shard, iterate_in_processes, iterate_on_file_shard_lines
+from dialogs_data_parsers.flibusta.columnar_dialogs import FlibustaColumnarDialogs
 
 _logger = logging.getLogger(__name__)
 
 
 class FlibustaDialogsIterator:
-    def __init__(self, file_path, logging_period):
+    def __init__(self, file_path, logging_period, yield_references=False, num_shards=1, shard_id=0, n_processes=1):
+        """
+        :param file_path: Dialogs jsonl file or the directory with its columnar export (see `export_flibusta_dialogs`).
+            The columnar export is read from the memory-mapped files without json parsing and yields the same samples.
+        :param yield_references: If True, compact (dialog_id, n_utterances) references are yielded instead of the
+            copied subdialog lists. Dialog id is the byte offset of the dialog line in the file. Without references
+            each prefix is a new list, so a dialog of n utterances costs O(n^2) copied items. Flibusta dialogs are
+            short (about 3 utterances on average), so it's negligible for them, but not for the long dialogs.
+        :param num_shards: Number of byte-range shards the file is split on. The iterator yields samples only from the
+            `shard_id` shard. Inside a PyTorch data loader worker, the shard is further split between the workers.
+        :param n_processes: If greater than 1, the shard is split between this number of processes and their samples
+            are merged (in non-deterministic order). Not supported inside a PyTorch data loader worker.
+        """
         self._file_path = file_path
+        self._is_columnar = Path(file_path).is_dir()
         self._logging_period = logging_period
+        self._yield_references = yield_references
+        self._num_shards = num_shards
+        self._shard_id = shard_id
+        self._n_processes = n_processes
 
     def __iter__(self):
-        with open(self._file_path) as file:
-            n_samples_done = 0
-            for n_lines_done, raw_line in enumerate(file, start=1):
-                if self._logging_period and n_lines_done % self._logging_period == 0:
-                    _logger.info(f'Flibusta lines: {n_lines_done}, samples: {n_samples_done}')
+        num_shards, shard_id = get_worker_shard(self._num_shards, self._shard_id)
+        if self._n_processes > 1:
+            shard_ids = range(shard_id * self._n_processes, (shard_id + 1) * self._n_processes)
+            yield from iterate_in_processes(self._iterate_on_shard, num_shards * self._n_processes, shard_ids)
+        else:
+            yield from self._iterate_on_shard(num_shards, shard_id)
 
-                dialog = json.loads(raw_line)
+    def _iterate_on_shard(self, num_shards, shard_id):
+        if self._is_columnar:
+            yield from self._iterate_on_columnar_shard(num_shards, shard_id)
+            return
 
-                for n_utterances in range(2, len(dialog) + 1):
-                    subdialog = dialog[:n_utterances]
+        lines = iterate_on_file_shard_lines(self._file_path, num_shards=num_shards, shard_id=shard_id)
+        n_samples_done = 0
+        for n_lines_done, (offset, raw_line) in enumerate(lines, start=1):
+            if self._logging_period and n_lines_done % self._logging_period == 0:
+                _logger.info(f'Flibusta lines: {n_lines_done}, samples: {n_samples_done}')
+
+            if self._yield_references:
+                n_utterances = len(json.loads(raw_line))
+                for prefix_length in range(2, n_utterances + 1):
                     n_samples_done += 1
-                    yield subdialog
+                    yield offset, prefix_length
+                continue
+
+            dialog = json.loads(raw_line)
+
+            # Samples are independent lists (consumers may keep or modify them), so the prefixes are copied:
+            for n_utterances in range(2, len(dialog) + 1):
+                subdialog = dialog[:n_utterances]
+                n_samples_done += 1
+                yield subdialog
+
+    def _iterate_on_columnar_shard(self, num_shards, shard_id):
+        with FlibustaColumnarDialogs(self._file_path) as dialogs:
+            start, end = get_shard_range(len(dialogs), num_shards=num_shards, shard_id=shard_id)
+            if self._yield_references:
+                for dialog_id, n_utterances in dialogs.iterate_lengths(start, end):
+                    for prefix_length in range(2, n_utterances + 1):
+                        yield dialog_id, prefix_length
+                return
+
+            for n_dialogs_done, (_, dialog) in enumerate(dialogs.iterate(start, end), start=1):
+                if self._logging_period and n_dialogs_done % self._logging_period == 0:
+                    _logger.info(f'Flibusta dialogs: {n_dialogs_done}')
+
+                for n_utterances in range(2, len(dialog) + 1):
+                    yield dialog[:n_utterances]
@@ -1,106 +1,379 @@
+import hashlib
 import json
 import logging
 import multiprocessing
+import os
 import re
+import resource
+import time
 import unicodedata
+from collections import Counter, defaultdict, namedtuple
 from pathlib import Path
 from zipfile import BadZipFile, ZipFile
 
-import bs4
 from more_itertools import chunked
 
+from dialogs_data_parsers.flibusta.book_index import FlibustaBookIndex
+from dialogs_data_parsers.flibusta.book_text_extractors import BOOK_LINES_EXTRACTORS
+from dialogs_data_parsers.utils import get_file_fingerprint, merge_files, open_atomic
+
 _logger = logging.getLogger(__name__)
 logging.getLogger("filelock").setLevel(logging.WARNING)
 
 DIALOG_SEPARATORS = '-‐‑‒–—―₋−⸺⸻﹘﹣－'
+_MIN_N_UTTERANCES = 2
+_DIALOG_SEPARATORS_SET = frozenset(DIALOG_SEPARATORS)
+_LEADING_NON_WORD_PATTERN = re.compile(r'\W*')
 
 
 class FlibustaDialogsParser:
-    _MIN_N_UTTERANCES = 2
     _ARCHIVE_PATTERN = re.compile(r'.*fb2-.+\.zip$')
 
     _DIALOGS_CHUNK_WRITE_SIZE = 1000
 
-    def __init__(self, flibusta_archives_dir, out_file_path):
+    def __init__(
+            self,
+            flibusta_archives_dir,
+            out_file_path,
+            book_lines_extractor='streaming',
+            sharded=False,
+            merge_shards=True,
+            resume=False,
+            n_books_per_work_unit=None,
+            n_workers=None,
+            skip_duplicate_books=False,
+            book_index_file_path=None):
+        """
+        :param sharded: If True, each work unit is written by its worker to its own shard file
+            (`<out_file_stem>.part-<archive_stem>[.<unit_id>].jsonl`) without any inter-process locking. Shards are
+            kept as checkpoints and completed archives are recorded in the `<out_file_stem>.manifest.json`.
+        :param merge_shards: If True (and `sharded`), shards are concatenated into `out_file_path` after all
+            archives are parsed.
+        :param resume: If True (requires `sharded`), archives which are already recorded in the manifest with the
+            same size and mtime and the same parse options (book lines extractor and duplicate books skipping), and
+            which shard files exist, are not parsed again.
+        :param n_books_per_work_unit: If set, archives are split on work units of this number of books (zip members).
+            Otherwise, each archive is a single work unit. Work units are scheduled largest first.
+        :param n_workers: Number of worker processes. Defaults to the number of cpus.
+        :param skip_duplicate_books: If True, the fb2 headers of all archives are pre-passed first (see
+            `FlibustaBookIndex`) and the books, which are duplicates of the previous ones (by the document id or by
+            the authors and title) or are not in russian, are skipped before their bodies are decompressed.
+        :param book_index_file_path: Persistent book index file, which is reused by the next runs. Defaults to
+            `<out_file_stem>.book_index.json`.
+        """
+        if book_lines_extractor not in BOOK_LINES_EXTRACTORS:
+            raise ValueError(f'Unknown book lines extractor: {book_lines_extractor}, '
+                             f'available: {list(BOOK_LINES_EXTRACTORS)}')
+        if resume and not sharded:
+            raise ValueError('Resuming is only supported for the sharded output')
+
         self._flibusta_archives_dir = flibusta_archives_dir
+        self._book_lines_extractor = book_lines_extractor
+        self._sharded = sharded
+        self._merge_shards = merge_shards
+        self._n_books_per_work_unit = n_books_per_work_unit
+        self._n_workers = n_workers or os.cpu_count()
+        self._skip_duplicate_books = skip_duplicate_books
+        # Parse options, which affect the dialogs of the archive shards:
+        self._parse_options = {
+            'book_lines_extractor': book_lines_extractor,
+            'skip_duplicate_books': skip_duplicate_books,
+        }
         self._out_file_path = Path(out_file_path)
+        self._book_index_file_path = Path(book_index_file_path or self._out_file_path.with_name(
+            f'{self._out_file_path.stem}.book_index.json'))
         self._out_file_path.parent.mkdir(exist_ok=True, parents=True)
         if self._out_file_path.is_file():
             self._out_file_path.unlink()
 
-        manager = multiprocessing.Manager()
-        self._archives_counter = manager.Value('i', 0)
-        self._dialogs_counter = manager.Value('i', 0)
-        self._out_file_lock = manager.Lock()
+        self._manifest_file_path = self._out_file_path.with_name(f'{self._out_file_path.stem}.manifest.json')
+        if resume:
+            self._manifest = self._load_manifest()
+        else:
+            self._manifest = {}
+            if self._manifest_file_path.is_file():
+                self._manifest_file_path.unlink()
+
+        self._out_file_lock = None if self._sharded else multiprocessing.Manager().Lock()
         self._archive_paths = list(self._iterate_on_archive_paths())
+        self._archive_paths_to_parse = None
 
     def run(self):
-        with multiprocessing.Pool() as pool:
-            pool.map(self._parse_archive, self._archive_paths)
+        archive_to_file_names, books_counter = self._get_archives_books_to_parse()
+        self._archive_paths_to_parse = [
+            path for path in self._archive_paths
+            if not self._is_archive_parsed(path, archive_to_file_names.get(path.name))
+        ]
+        n_archives_done = len(self._archive_paths) - len(self._archive_paths_to_parse)
+        n_dialogs_done = sum(self._manifest[path.name]['n_dialogs'] for path in self._archive_paths
+                             if path not in self._archive_paths_to_parse)
+        if n_archives_done:
+            _logger.info(f'Resuming, archives already parsed: {n_archives_done}, dialogs: {n_dialogs_done}')
+
+        work_units = self._get_work_units(archive_to_file_names)
+        archive_to_n_units_left = Counter(work_unit.archive_path for work_unit in work_units)
+        archive_to_shard_names = defaultdict(list)
+        archive_to_n_dialogs = Counter()
+
+        start_time = time.time()
+        workers_cpu_time = 0
+        worker_to_peak_rss = {}
+        extraction_counter = Counter()
+        with multiprocessing.Pool(processes=self._n_workers) as pool:
+            results = pool.imap_unordered(self._parse_work_unit, work_units, chunksize=1)
+            for n_units_done, (work_unit, n_unit_dialogs, unit_cpu_time, worker_pid, peak_rss,
+                               unit_extraction_counter) in enumerate(results, start=1):
+                archive_path = work_unit.archive_path
+                archive_to_n_units_left[archive_path] -= 1
+                archive_to_shard_names[archive_path].append(self._get_shard_file_path(work_unit).name)
+                archive_to_n_dialogs[archive_path] += n_unit_dialogs
+                n_dialogs_done += n_unit_dialogs
+                workers_cpu_time += unit_cpu_time
+                worker_to_peak_rss[worker_pid] = peak_rss
+                extraction_counter.update(unit_extraction_counter)
+
+                if archive_to_n_units_left[archive_path] == 0:
+                    n_archives_done += 1
+                    if self._sharded:
+                        self._manifest[archive_path.name] = dict(
+                            get_file_fingerprint(archive_path),
+                            n_dialogs=archive_to_n_dialogs[archive_path],
+                            shard_names=sorted(archive_to_shard_names[archive_path]),
+                            parse_options=self._parse_options,
+                            books_hash=_get_books_hash(archive_to_file_names.get(archive_path.name)))
+                        self._save_manifest()
+
+                elapsed_time = time.time() - start_time
+                _logger.info(f'Work units: {n_units_done}/{len(work_units)}, '
+                             f'Archives: {n_archives_done}/{len(self._archive_paths)}, Dialogs: {n_dialogs_done}, '
+                             f'Elapsed: {elapsed_time:.1f}s, '
+                             f'CPU utilization: {_get_utilization(workers_cpu_time, elapsed_time, self._n_workers)}, '
+                             f'Worker peak RSS: {_format_rss(max(worker_to_peak_rss.values()))}')
+
+        elapsed_time = time.time() - start_time
+        _logger.info(f'Parsing done. Wall time: {elapsed_time:.1f}s, workers CPU time: {workers_cpu_time:.1f}s, '
+                     f'workers: {self._n_workers}, '
+                     f'CPU utilization: {_get_utilization(workers_cpu_time, elapsed_time, self._n_workers)}')
+        if worker_to_peak_rss:
+            # Sum of the workers peaks is the upper bound of their total memory:
+            _logger.info(f'Workers peak RSS: max {_format_rss(max(worker_to_peak_rss.values()))}, '
+                         f'total {_format_rss(sum(worker_to_peak_rss.values()))}, '
+                         f'workers: {len(worker_to_peak_rss)}')
+        if extraction_counter:
+            _logger.info(f'Books parsed by the bs4 fallback: {extraction_counter["n_fallback_books"]}, '
+                         f'continued by the bs4 fallback after a late parse error: '
+                         f'{extraction_counter["n_late_fallback_books"]}')
+        if self._skip_duplicate_books:
+            _logger.info(f'Books: {books_counter["n_books"]}, '
+                         f'skipped duplicates: {books_counter["n_duplicate_books"]}, '
+                         f'skipped non-ru: {books_counter["n_non_ru_books"]}')
+
+        if self._sharded and self._merge_shards:
+            self._merge_shard_files()
 
     def _iterate_on_archive_paths(self):
         for path in Path(self._flibusta_archives_dir).iterdir():
             if self._ARCHIVE_PATTERN.match(path.name):
                 yield path
 
-    def _parse_archive(self, archive_path):
-        dialogs = self._iterate_on_dialogs(archive_path)
+    def _get_archives_books_to_parse(self):
+        if not self._skip_duplicate_books:
+            return {}, Counter()
+
+        book_index = FlibustaBookIndex(self._book_index_file_path)
+        book_index.update(self._archive_paths, n_workers=self._n_workers)
+        archive_to_file_names, books_counter = book_index.get_archives_books_to_parse(
+            path.name for path in self._archive_paths)
+        _logger.info(f'Books index is updated: {self._book_index_file_path}')
+
+        return archive_to_file_names, books_counter
+
+    def _get_work_units(self, archive_to_file_names):
+        work_units = []
+        for archive_path in self._archive_paths_to_parse:
+            file_names = archive_to_file_names.get(archive_path.name)
+            if self._n_books_per_work_unit is None:
+                work_units.append(_WorkUnit(archive_path, None, file_names, archive_path.stat().st_size))
+            else:
+                work_units.extend(self._iterate_on_archive_work_units(archive_path, file_names))
+
+        work_units.sort(key=lambda work_unit: work_unit.size, reverse=True)
+
+        return work_units
+
+    def _iterate_on_archive_work_units(self, archive_path, file_names=None):
+        try:
+            with ZipFile(archive_path, 'r') as zip_file:
+                zip_infos = zip_file.infolist()
+        except BadZipFile:
+            _logger.warning(f'Bad zip file: {archive_path}')
+            zip_infos = []
+
+        if file_names is not None:
+            file_names = set(file_names)
+            zip_infos = [zip_info for zip_info in zip_infos if zip_info.filename in file_names]
+
+        zip_infos_chunks = list(chunked(zip_infos, n=self._n_books_per_work_unit)) or [[]]
+        for unit_id, zip_infos_chunk in enumerate(zip_infos_chunks):
+            file_names = [zip_info.filename for zip_info in zip_infos_chunk]
+            size = sum(zip_info.compress_size for zip_info in zip_infos_chunk)
+            yield _WorkUnit(archive_path, unit_id, file_names, size)
+
+    def _get_shard_file_path(self, work_unit):
+        out_file_path = self._out_file_path
+        shard_name = work_unit.archive_path.stem
+        if work_unit.unit_id is not None:
+            shard_name += f'.{work_unit.unit_id:05d}'
+
+        return out_file_path.with_name(f'{out_file_path.stem}.part-{shard_name}{out_file_path.suffix}')
+
+    def _load_manifest(self):
+        if not self._manifest_file_path.is_file():
+            return {}
+
+        with open(self._manifest_file_path) as file:
+            return json.load(file)
+
+    def _save_manifest(self):
+        with open_atomic(self._manifest_file_path, fsync=True) as file:
+            json.dump(self._manifest, file, ensure_ascii=False, indent=1)
+
+    def _is_archive_parsed(self, archive_path, file_names):
+        archive_record = self._manifest.get(archive_path.name)
+        if archive_record is None or archive_record.get('parse_options') != self._parse_options:
+            return False
+
+        # The first copy of a duplicate book moves to another archive, if the archives before it have changed:
+        if archive_record.get('books_hash') != _get_books_hash(file_names):
+            return False
+
+        shard_file_paths = [self._out_file_path.with_name(name) for name in archive_record['shard_names']]
+        if not all(path.is_file() for path in shard_file_paths):
+            return False
 
-        for dialogs_chunk in chunked(dialogs, n=self._DIALOGS_CHUNK_WRITE_SIZE):
-            payloads = []
-            for dialog in dialogs_chunk:
-                payload = json.dumps(dialog, ensure_ascii=False)
-                payloads.append(payload)
+        archive_fingerprint = get_file_fingerprint(archive_path)
+        return all(archive_record.get(key) == value for key, value in archive_fingerprint.items())
 
-            chunk_payload = '\n'.join(payloads)
+    def _parse_work_unit(self, work_unit):
+        start_cpu_time = time.process_time()
+        extraction_counter = Counter()
+        dialogs = iterate_on_archive_dialogs(
+            work_unit.archive_path,
+            self._book_lines_extractor,
+            file_names=work_unit.file_names,
+            extraction_counter=extraction_counter)
+        n_dialogs_done = 0
 
-            self._out_file_lock.acquire()
+        if self._sharded:
+            shard_file = open(self._get_shard_file_path(work_unit), 'w')
+
+        try:
+            for dialogs_chunk in chunked(dialogs, n=self._DIALOGS_CHUNK_WRITE_SIZE):
+                payloads = []
+                for dialog in dialogs_chunk:
+                    payload = json.dumps(dialog, ensure_ascii=False)
+                    payloads.append(payload)
+
+                chunk_payload = '\n'.join(payloads) + '\n'
+
+                if self._sharded:
+                    shard_file.write(chunk_payload)
+                else:
+                    self._write_chunk_payload_with_lock(chunk_payload)
+
+                n_dialogs_done += len(dialogs_chunk)
+                _logger.debug(f'Archive: {work_unit.archive_path}, work unit: {work_unit.unit_id}, '
+                              f'Dialogs: {n_dialogs_done}')
+        finally:
+            if self._sharded:
+                shard_file.flush()
+                os.fsync(shard_file.fileno())
+                shard_file.close()
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        cpu_time = time.process_time() - start_cpu_time
+        return work_unit, n_dialogs_done, cpu_time, os.getpid(), peak_rss, extraction_counter
+
+    def _write_chunk_payload_with_lock(self, chunk_payload):
+        with self._out_file_lock:
             with open(self._out_file_path, 'a') as out_file:
                 out_file.write(chunk_payload)
-                out_file.write('\n')
                 out_file.flush()
-            self._out_file_lock.release()
 
-            self._dialogs_counter.value += len(dialogs_chunk)
-            _logger.info(f'Archives: {self._archives_counter.value}/{len(self._archive_paths)}, '
-                         f'Dialogs: {self._dialogs_counter.value}')
+    def _merge_shard_files(self):
+        shard_file_paths = []
+        for archive_path in sorted(self._archive_paths):
+            shard_names = self._manifest[archive_path.name]['shard_names']
+            shard_file_paths.extend(self._out_file_path.with_name(name) for name in shard_names)
 
-        self._archives_counter.value += 1
+        merge_files(shard_file_paths, self._out_file_path)
+        _logger.info(f'{len(shard_file_paths)} shards merged into: {self._out_file_path}')
 
-    def _iterate_on_dialogs(self, archive_path):
-        book_texts = self._iterate_on_book_texts(archive_path)
-        dialog_separators_set = set(DIALOG_SEPARATORS)
 
-        for book_text in book_texts:
-            book_text_lines = re.split('\n+', book_text)
-            dialog = []
+_WorkUnit = namedtuple('_WorkUnit', ('archive_path', 'unit_id', 'file_names', 'size'))
 
-            for line in book_text_lines:
-                line = line.strip()
 
-                if len(line) > 2 and line[0] in dialog_separators_set:
-                    line = unicodedata.normalize("NFKC", line)
-                    line = re.sub(r'^\W+', '', line)
-                    dialog.append(line)
-                else:
-                    if len(dialog) >= self._MIN_N_UTTERANCES:
-                        yield dialog
+def _get_books_hash(file_names):
+    """Returns the hash of the archive books to parse (None, if all books are parsed)."""
+    if file_names is None:
+        return None
+
+    return hashlib.blake2b('\n'.join(file_names).encode(), digest_size=16).hexdigest()
+
+
+def _get_utilization(cpu_time, elapsed_time, n_workers):
+    return f'{100 * cpu_time / max(elapsed_time * n_workers, 1e-9):.1f}%'
+
+
+def _format_rss(n_bytes):
+    return f'{n_bytes / 2**20:.1f} MB'
 
-                    dialog = []
 
-            if len(dialog) >= self._MIN_N_UTTERANCES:
+def iterate_on_archive_dialogs(
+        archive_path, book_lines_extractor='streaming', file_names=None, extraction_counter=None):
+    """
+    :param extraction_counter: Optional `Counter` of the book lines extraction events (see `BOOK_LINES_EXTRACTORS`).
+    """
+    books_lines = _iterate_on_archive_books_lines(archive_path, book_lines_extractor, file_names, extraction_counter)
+    for book_lines in books_lines:
+        yield from iterate_on_book_dialogs(book_lines)
+
+
+def iterate_on_book_dialogs(book_lines):
+    """Single pass over the book lines which yields dialogs: runs of at least 2 consecutive lines, which start with
+    a dialog separator.
+
+    Utterances are NFKC-normalized (only if they are not normalized already) and stripped of the leading non-word
+    characters.
+
+    :param book_lines: Iterable of the book text lines (see `BOOK_LINES_EXTRACTORS`), consumed lazily.
+    """
+    dialog = []
+    for line in book_lines:
+        line = line.strip()
+
+        if len(line) > 2 and line[0] in _DIALOG_SEPARATORS_SET:
+            if not line.isascii() and not unicodedata.is_normalized('NFKC', line):
+                line = unicodedata.normalize('NFKC', line)
+
+            dialog.append(line[_LEADING_NON_WORD_PATTERN.match(line).end():])
+        else:
+            if len(dialog) >= _MIN_N_UTTERANCES:
                 yield dialog
 
-    def _iterate_on_book_texts(self, archive_path):
-        try:
-            with ZipFile(archive_path, 'r') as zip_file:
-                for file_name in zip_file.namelist():
-                    raw_fb2_text = zip_file.read(file_name)
-                    book_soup = bs4.BeautifulSoup(raw_fb2_text, features="html.parser")
-                    lang_tag = book_soup.find('lang')
-
-                    if lang_tag and lang_tag.text.lower().strip() == 'ru':
-                        book_text = book_soup.text
-                        yield book_text
-        except BadZipFile:
-            _logger.warning(f'Bad zip file: {archive_path}')
+            dialog = []
+
+    if len(dialog) >= _MIN_N_UTTERANCES:
+        yield dialog
+
+
+def _iterate_on_archive_books_lines(archive_path, book_lines_extractor, file_names, extraction_counter):
+    iterate_on_book_lines = BOOK_LINES_EXTRACTORS[book_lines_extractor]
+    try:
+        with ZipFile(archive_path, 'r') as zip_file:
+            for file_name in file_names if file_names is not None else zip_file.namelist():
+                # Member is decompressed lazily, while its lines are consumed:
+                with zip_file.open(file_name) as raw_fb2_file:
+                    yield iterate_on_book_lines(raw_fb2_file, counter=extraction_counter)
+    except BadZipFile:
+        _logger.warning(f'Bad zip file: {archive_path}')
@@ -0,0 +1,123 @@
+import json
+import logging
+from array import array
+from pathlib import Path
+
+from dialogs_data_parsers.common.columnar import StringColumn, StringColumnWriter, load_array, save_array
+from dialogs_data_parsers.pikabu.comment_tree import get_tree_arrays
+
+_logger = logging.getLogger(__name__)
+_URLS = 'urls'
+_STORY_NODE_OFFSETS = 'story_node_offsets'
+_COMMENT_IDS = 'comment_ids'
+_PARENTS = 'parents'
+_TEXTS = 'texts'
+_METAS = 'metas'
+
+
+def export_pikabu_stories(stories_file_path, out_dir, logging_period=10000):
+    """Converts pikabu stories jsonl file to the columnar format, which is read by `PikabuColumnarStories`.
+
+    Only the comments trees are exported (it's all the dialogs iterators need). Trees are stored as the
+    `CommentTree` node arrays, so they are restored without any parsing:
+        - urls: strings column of the story urls;
+        - story_node_offsets: index of the first node (the dummy root) of each story (plus the total number of nodes);
+        - comment_ids, parents: `CommentTree` node arrays, parent indexes are local to the story;
+        - texts, metas: strings columns of the raw comments texts and metas (empty for the roots and missing values).
+
+    :return: Number of exported stories.
+    """
+    writer = PikabuColumnarStoriesWriter(out_dir)
+    with open(stories_file_path) as file:
+        for raw_line in file:
+            line_data = json.loads(raw_line)
+            comment_ids, parents, comments = get_tree_arrays(line_data['comments'], lambda id_, comment: comment)
+            writer.add(line_data['url'], comment_ids, parents, comments)
+
+            if logging_period and len(writer) % logging_period == 0:
+                _logger.info(f'Pikabu stories exported: {len(writer)}')
+
+    writer.close()
+
+    return len(writer)
+
+
+class PikabuColumnarStoriesWriter:
+    """Writes stories trees to the columnar format (see `export_pikabu_stories`)."""
+
+    def __init__(self, out_dir):
+        out_dir = Path(out_dir)
+        self._out_dir = out_dir
+        self._urls = StringColumnWriter(out_dir, _URLS)
+        self._texts = StringColumnWriter(out_dir, _TEXTS)
+        self._metas = StringColumnWriter(out_dir, _METAS)
+        self._story_node_offsets = array('q', [0])
+        self._comment_ids = array('q')
+        self._parents = array('i')
+
+    def __len__(self):
+        return len(self._urls)
+
+    def add(self, url, comment_ids, parents, comments):
+        """Adds the story tree.
+
+        :param comment_ids, parents: `CommentTree` node arrays (see `get_tree_arrays`).
+        :param comments: Comment dict (with optional `text` and `meta` fields) or None of each node.
+        """
+        self._urls.append(url)
+        self._comment_ids.extend(comment_ids)
+        self._parents.extend(parents)
+        self._story_node_offsets.append(len(self._comment_ids))
+        for comment in comments:
+            comment = comment or {}
+            self._texts.append(comment.get('text') or '')
+            self._metas.append(comment.get('meta') or '')
+
+    def close(self):
+        for column in (self._urls, self._texts, self._metas):
+            column.close()
+        save_array(self._out_dir, _STORY_NODE_OFFSETS, self._story_node_offsets)
+        save_array(self._out_dir, _COMMENT_IDS, self._comment_ids)
+        save_array(self._out_dir, _PARENTS, self._parents, dtype=self._parents.typecode)
+
+
+class PikabuColumnarStories:
+    """Memory-mapped stories exported by `export_pikabu_stories`."""
+
+    def __init__(self, dir_path):
+        self._urls = StringColumn(dir_path, _URLS)
+        self._texts = StringColumn(dir_path, _TEXTS)
+        self._metas = StringColumn(dir_path, _METAS)
+        self._story_node_offsets = load_array(dir_path, _STORY_NODE_OFFSETS)
+        self._comment_ids = load_array(dir_path, _COMMENT_IDS)
+        self._parents = load_array(dir_path, _PARENTS)
+
+    def __len__(self):
+        return len(self._urls)
+
+    def iterate(self, start=0, end=None):
+        """Yields (url, comment_ids, parents, texts, metas) tuples of the stories with indexes in [start, end).
+
+        `comment_ids` and `parents` are arrays which can be passed to `CommentTree` directly.
+        """
+        end = len(self) if end is None else end
+        story_node_offsets = self._story_node_offsets[start:end + 1].tolist()
+        urls = self._urls.get_range(start, end)
+
+        for i, url in enumerate(urls):
+            node_start, node_end = story_node_offsets[i], story_node_offsets[i + 1]
+            comment_ids = array('q', self._comment_ids[node_start:node_end].tobytes())
+            parents = array('i', self._parents[node_start:node_end].tobytes())
+            texts = self._texts.get_range(node_start, node_end)
+            metas = self._metas.get_range(node_start, node_end)
+            yield url, comment_ids, parents, texts, metas
+
+    def close(self):
+        for column in (self._urls, self._texts, self._metas):
+            column.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,114 @@
+import re
+from itertools import islice
+from typing import Optional
+
+_WORD_REGEX = re.compile(r'\w+')
+_NON_LETTERS_REGEX = re.compile(r'[\W\d_]+')
+_CYRILLIC_DELETION_TABLE = dict.fromkeys([*range(ord('А'), ord('я') + 1), ord('ё'), ord('Ё')])
+_DELETED_COMMENT_PREFIX = 'Комментарий удален.'
+
+
+class CommentFilter:
+    """Pipeline of comment text filters with an optional per-comment-id cache of their results.
+
+    Comment text is normalized (newlines are replaced with spaces, the text is stripped) and then passed through
+    the filters in order: each filter is a callable which takes the normalized text and returns True, if the comment
+    must be kept. Pikabu comment ids are unique, so the result can be cached by id and the repeated passes over the
+    same stories (e.g. by different iterators, which share the filter object) don't filter the comments again.
+    """
+
+    def __init__(self, filters, use_cache=False):
+        """
+        :param filters: Sequence of text filters (see `get_default_filters`). Put the cheapest ones first.
+        :param use_cache: Cache the results by comment id. Cache keeps all the kept comments texts of all the passed
+            stories in memory, so enable it only if the same filter object is reused for several passes over a
+            dataset, which fits in memory. Each process of the multi-process iteration has its own copy of the cache.
+        """
+        self._filters = tuple(filters)
+        self._cache = {} if use_cache else None
+
+    def __call__(self, comment_id, text) -> Optional[str]:
+        """Returns the normalized comment text or None, if the comment is filtered out."""
+        if self._cache is not None:
+            try:
+                return self._cache[comment_id]
+            except KeyError:
+                pass
+
+        result = self._process(text)
+        if self._cache is not None:
+            self._cache[comment_id] = result
+
+        return result
+
+    def _process(self, text):
+        if not text:
+            return None
+
+        text = text.replace('\n', ' ').strip()
+        if not text:
+            return None
+
+        for filter_ in self._filters:
+            if not filter_(text):
+                return None
+
+        return text
+
+    @property
+    def params(self):
+        """Json-serializable description of the filters, e.g. to key the caches of the filtered data."""
+        return [getattr(filter_, '__name__', None) or repr(filter_) for filter_ in self._filters]
+
+
+class MaxNWordsFilter:
+    """Keeps texts with at most `max_n_words` words. Words are counted lazily up to the first excessive one."""
+
+    def __init__(self, max_n_words):
+        self._max_n_words = max_n_words
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(max_n_words={self._max_n_words})'
+
+    def __call__(self, text):
+        n_words = sum(1 for _ in islice(_WORD_REGEX.finditer(text), self._max_n_words + 1))
+        return n_words <= self._max_n_words
+
+
+class CyrillicRatioFilter:
+    """Keeps texts in which cyrillic letters make up at least `min_ratio` of all letters (texts without letters
+    are kept)."""
+
+    def __init__(self, min_ratio):
+        self._min_ratio = min_ratio
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(min_ratio={self._min_ratio})'
+
+    def __call__(self, text):
+        n_letters = len(_NON_LETTERS_REGEX.sub('', text))
+        if not n_letters:
+            return True
+
+        n_cyrillic_letters = len(text) - len(text.translate(_CYRILLIC_DELETION_TABLE))
+        return n_cyrillic_letters >= self._min_ratio * n_letters
+
+
+def is_without_urls_and_mentions(text):
+    return '@' not in text and 'http' not in text
+
+
+def is_not_deleted(text):
+    return not text.startswith(_DELETED_COMMENT_PREFIX)
+
+
+def get_default_filters(max_n_words_per_utterance, min_cyrillic_ratio=None):
+    """Returns filters of the pikabu dialogs iterators.
+
+    :param min_cyrillic_ratio: If set, the comments with lower ratio of cyrillic letters are filtered out too.
+    """
+    filters = [is_without_urls_and_mentions, is_not_deleted, MaxNWordsFilter(max_n_words_per_utterance)]
+    if min_cyrillic_ratio is not None:
+        filters.append(CyrillicRatioFilter(min_cyrillic_ratio))
+
+    return filters
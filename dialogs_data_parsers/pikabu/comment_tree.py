@@ -0,0 +1,152 @@
+from array import array
+
+
+class CommentTree:
+    """Compact comments tree: nodes are stored in parallel arrays of parent / first child / next sibling indexes.
+
+    Node 0 is the dummy root (the story itself). Each other node has a data object or None, if the comment was
+    filtered out. Children of each node are ordered by their comment ids.
+    """
+
+    def __init__(self, comment_ids, parents, data):
+        """
+        :param comment_ids: Comment id of each node (0 for the root).
+        :param parents: Parent node index of each node (-1 for the root).
+        :param data: Data object of each node (None for the root and for the filtered out comments).
+        """
+        n_nodes = len(comment_ids)
+        self._comment_ids = comment_ids
+        self._parents = parents
+        self._data = data
+        self._first_children = array('i', [-1]) * n_nodes
+        self._next_siblings = array('i', [-1]) * n_nodes
+        self._id_to_node = None
+
+        # Nodes are linked in the reversed order, so children lists are in the original (ascending ids) order.
+        for node in range(n_nodes - 1, 0, -1):
+            parent = parents[node]
+            self._next_siblings[node] = self._first_children[parent]
+            self._first_children[parent] = node
+
+    @classmethod
+    def from_comments(cls, comments, get_node_data):
+        """Builds tree from the `comments` dict of the pikabu story (see `get_tree_arrays`)."""
+        return cls(*get_tree_arrays(comments, get_node_data))
+
+    def __len__(self):
+        return len(self._comment_ids) - 1
+
+    def iterate_on_dialogs(self):
+        """Yields all dialogs (lists of node data objects) which can be obtained from the tree.
+
+        A dialog is a path from the top-level comment (or from the comment after the filtered out one) to any
+        comment in its subtree, which contains at least 2 utterances. Dialogs are enumerated by the iterative
+        depth-first search, so all prefixes of the root-to-leaf paths are yielded directly.
+        """
+        data = self._data
+        path = []
+        # Stack of (node, depth of the parent, index of the current dialog start in the path):
+        stack = [(child, 0, 0) for child in reversed(self._get_children(0))]
+
+        while stack:
+            node, parent_depth, dialog_start = stack.pop()
+            del path[parent_depth:]
+            node_data = data[node]
+            path.append(node_data)
+            depth = parent_depth + 1
+
+            if node_data is None:
+                dialog_start = depth
+            elif depth - dialog_start >= 2:
+                yield path[dialog_start:depth]
+
+            stack.extend((child, depth, dialog_start) for child in reversed(self._get_children(node)))
+
+    def iterate_on_unique_dialogs(self, get_key, as_references=False):
+        """Yields each unique dialog from `iterate_on_dialogs` exactly once, in O(number of nodes).
+
+        Dialogs are deduplicated by the keys of their utterances via prefix trie which is built along the search:
+        a dialog is yielded only when its last utterance creates a new trie node. So, among the dialogs with
+        the same keys only the first one (in the depth-first order) is yielded.
+
+        :param get_key: Callable which takes node data and returns a hashable key (e.g. utterance text).
+        :param as_references: If True, compact (comment_id, n_utterances) references are yielded instead of the
+            dialog lists. A reference can be resolved by `get_dialog`.
+        """
+        data = self._data
+        comment_ids = self._comment_ids
+        path = []
+        trie_root = {}
+        # Stack of (node, depth of the parent, index of the current dialog start in the path, parent trie node):
+        stack = [(child, 0, 0, trie_root) for child in reversed(self._get_children(0))]
+
+        while stack:
+            node, parent_depth, dialog_start, parent_trie_node = stack.pop()
+            del path[parent_depth:]
+            node_data = data[node]
+            path.append(node_data)
+            depth = parent_depth + 1
+
+            if node_data is None:
+                dialog_start = depth
+                trie_node = trie_root
+            else:
+                key = get_key(node_data)
+                trie_node = parent_trie_node.get(key)
+                if trie_node is None:
+                    trie_node = parent_trie_node[key] = {}
+                    n_utterances = depth - dialog_start
+                    if n_utterances >= 2:
+                        yield (comment_ids[node], n_utterances) if as_references else path[dialog_start:depth]
+
+            stack.extend((child, depth, dialog_start, trie_node) for child in reversed(self._get_children(node)))
+
+    def get_dialog(self, comment_id, n_utterances):
+        """Resolves the (comment_id, n_utterances) reference to the dialog list."""
+        if self._id_to_node is None:
+            self._id_to_node = {id_: node for node, id_ in enumerate(self._comment_ids)}
+
+        node = self._id_to_node[comment_id]
+        dialog = []
+        for _ in range(n_utterances):
+            dialog.append(self._data[node])
+            node = self._parents[node]
+        dialog.reverse()
+
+        return dialog
+
+    def _get_children(self, node):
+        children = []
+        child = self._first_children[node]
+        while child != -1:
+            children.append(child)
+            child = self._next_siblings[child]
+
+        return children
+
+
+def get_tree_arrays(comments, get_node_data):
+    """Returns (comment_ids, parents, data) arrays of the `CommentTree` nodes.
+
+    :param comments: Dict comment id (str) -> comment dict with `parent_id` field.
+    :param get_node_data: Callable which takes comment id (int) and comment dict and returns node data object or
+        None, if the comment must be filtered out.
+    """
+    ids_and_comments = sorted((int(id_), comment) for id_, comment in comments.items()) if comments else []
+    id_to_node = {0: 0}
+    comment_ids = array('q', [0])
+    parents = array('i', [-1])
+    data = [None]
+
+    for id_, comment in ids_and_comments:
+        parent = id_to_node.get(int(comment['parent_id']))
+        if parent is None:
+            # Parent comment is absent, skip the whole orphan subtree.
+            continue
+
+        id_to_node[id_] = len(comment_ids)
+        comment_ids.append(id_)
+        parents.append(parent)
+        data.append(get_node_data(id_, comment))
+
+    return comment_ids, parents, data
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+from dialogs_data_parsers.pikabu.columnar_stories import PikabuColumnarStoriesWriter
+
+_logger = logging.getLogger(__name__)
+_MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def prepare_dialog_trees_cache(cache_dir, source_path, params, iterate_on_tree_arrays):
+    """Returns the directory of the preprocessed dialog trees cache of the source, builds it if needed.
+
+    The cache is the columnar stories export (see `PikabuColumnarStories`) of the already filtered trees: kept
+    comments have their processed texts, filtered out comments have empty texts. The cache directory is keyed by
+    the source path and the preprocessing `params`. The cache is rebuilt if the source fingerprint (size and
+    modification time) has changed, e.g. when new stories are appended to the source file.
+
+    :param params: Json-serializable preprocessing parameters.
+    :param iterate_on_tree_arrays: Callable without arguments which returns iterable of the source
+        (url, comment_ids, parents, data) tuples, where data is a list of {'text', 'meta'} dicts or None.
+    """
+    source_path = Path(source_path).resolve()
+    key = json.dumps({'source_path': str(source_path), 'params': params}, sort_keys=True, ensure_ascii=False)
+    cache_path = Path(cache_dir) / hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    fingerprint = get_path_fingerprint(source_path)
+
+    if _is_cache_valid(cache_path, fingerprint):
+        return cache_path
+
+    _logger.info(f'Building pikabu dialog trees cache: {cache_path}, source: {source_path}')
+    start_time = time.time()
+    tmp_cache_path = cache_path.with_name(f'{cache_path.name}.tmp-{os.getpid()}')
+    shutil.rmtree(tmp_cache_path, ignore_errors=True)
+
+    writer = PikabuColumnarStoriesWriter(tmp_cache_path)
+    for url, comment_ids, parents, data in iterate_on_tree_arrays():
+        writer.add(url, comment_ids, parents, data)
+    writer.close()
+
+    manifest = {'source_path': str(source_path), 'params': params, 'fingerprint': fingerprint, 'n_stories': len(writer)}
+    with open(tmp_cache_path / _MANIFEST_FILE_NAME, 'w') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+
+    # Other process (e.g. another data loader worker) could build the same cache concurrently:
+    if _is_cache_valid(cache_path, fingerprint):
+        shutil.rmtree(tmp_cache_path)
+    else:
+        shutil.rmtree(cache_path, ignore_errors=True)
+        os.replace(tmp_cache_path, cache_path)
+
+    _logger.info(f'Pikabu dialog trees cache is built: {cache_path}, stories: {len(writer)}, '
+                 f'elapsed: {time.time() - start_time:.1f}s')
+
+    return cache_path
+
+
+def get_path_fingerprint(path):
+    """Returns the size and modification time of the file or of each file in the directory."""
+    path = Path(path)
+    if path.is_dir():
+        return {file_path.name: get_path_fingerprint(file_path) for file_path in sorted(path.iterdir())}
+
+    stat = path.stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _is_cache_valid(cache_path, fingerprint):
+    try:
+        with open(cache_path / _MANIFEST_FILE_NAME) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return False
+
+    return manifest['fingerprint'] == fingerprint
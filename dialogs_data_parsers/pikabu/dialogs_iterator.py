@@ -1,92 +1,140 @@
 import json
 import logging
 import re
-from typing import Optional
+from pathlib import Path
 
-from treelib import Tree
-
-from dialogs_data_parsers.utils import iterate_on_parts_by_condition
+from dialogs_data_parsers.common.sharding import get_shard_range, \
+    get_worker_shard, iterate_in_processes, iterate_on_file_shard_lines
+from dialogs_data_parsers.pikabu.columnar_stories import PikabuColumnarStories
+from dialogs_data_parsers.pikabu.comment_filter import CommentFilter, get_default_filters
+from dialogs_data_parsers.pikabu.comment_tree import CommentTree, get_tree_arrays
+from dialogs_data_parsers.pikabu.dialog_trees_cache import prepare_dialog_trees_cache
 
 _logger = logging.getLogger(__name__)
 
 
 class PikabuDialogsWithMetaIterator:
-    def __init__(self, file_path, max_n_words_per_utterance, logging_period=10000):
+    def __init__(
+            self,
+            file_path,
+            max_n_words_per_utterance,
+            logging_period=10000,
+            yield_references=False,
+            num_shards=1,
+            shard_id=0,
+            n_processes=1,
+            comment_filter=None,
+            cache_dir=None):
+        """
+        :param file_path: Stories jsonl file or the directory with its columnar export (see `export_pikabu_stories`).
+            The columnar export is read from the memory-mapped files without json parsing and yields the same samples.
+        :param yield_references: If True, compact (story url, comment id, number of utterances) references are yielded
+            instead of the dialogs. The dialog can be restored from the story tree via `CommentTree.get_dialog`.
+        :param num_shards: Number of byte-range shards the file is split on. The iterator yields samples only from the
+            `shard_id` shard. Inside a PyTorch data loader worker, the shard is further split between the workers.
+        :param n_processes: If greater than 1, the shard is split between this number of processes and their samples
+            are merged (in non-deterministic order). Not supported inside a PyTorch data loader worker.
+        :param comment_filter: `CommentFilter` of the comments texts. Pass the same object with `use_cache=True` to
+            several iterators to reuse its cache. By default, the filter with
+            `get_default_filters(max_n_words_per_utterance)` is used without cache, so the memory is bounded by one
+            story.
+        :param cache_dir: If set, the filtered trees are written to the cache in this directory on the first
+            iteration, and the next iterations read them from the cache without json parsing and filtering. The cache
+            is keyed by the file path and the filter params, and it's rebuilt when the file changes.
+        """
         self._file_path = file_path
+        self._is_columnar = Path(file_path).is_dir()
         self._logging_period = logging_period
-        self._max_n_words_per_utterance = max_n_words_per_utterance
+        self._comment_filter = comment_filter or CommentFilter(get_default_filters(max_n_words_per_utterance))
+        self._yield_references = yield_references
+        self._num_shards = num_shards
+        self._shard_id = shard_id
+        self._n_processes = n_processes
+        self._cache_dir = cache_dir
+        self._cache_path = None
 
     def __iter__(self):
-        with open(self._file_path) as file:
-            n_samples_done = 0
-            for n_lines_done, raw_line in enumerate(file, start=1):
-                if self._logging_period and n_lines_done % self._logging_period == 0:
-                    _logger.info(f'Pikabu lines: {n_lines_done}, samples: {n_samples_done}')
-
-                line_data = json.loads(raw_line)
-                dialog_tree = self._get_dialog_tree(line_data)
-                dialogs = _iterate_on_dialogs_from_tree(dialog_tree)
-                dialogs = set(dialogs)
-
-                subdialogs = set()
-
-                for dialog in dialogs:
-                    dialog = tuple(dialog)
-                    for n_utterances in range(2, len(dialog) + 1):
-                        subdialog = tuple(dialog[:n_utterances])
-                        subdialogs.add(_Dialog(subdialog))
-
-                n_samples_done += len(subdialogs)
-                for subdialog in subdialogs:
-                    yield tuple(subdialog)
-
-    def _get_dialog_tree(self, line_data):
-        tree = Tree()
-        tree.create_node(identifier=0)
-        comments = line_data['comments']
-        if comments:
-            ids_and_comments = ((int(id_), comment) for id_, comment in comments.items())
-            ids_and_comments = sorted(ids_and_comments, key=lambda x: x[0])
-
-            for id_, comment_json in ids_and_comments:
-                parent_id = int(comment_json['parent_id'])
-                comment = comment_json['text']
-                comment = comment.replace('\n', ' ')
-                comment_text = self._process_comment(comment)
-                if comment_text:
-                    meta = comment_json.get('meta')
-                    data = {'text': comment_text, 'meta': meta}
+        if self._cache_dir is not None:
+            self._cache_path = prepare_dialog_trees_cache(
+                self._cache_dir,
+                self._file_path,
+                params=self._comment_filter.params,
+                iterate_on_tree_arrays=lambda: self._iterate_on_source_tree_arrays(num_shards=1, shard_id=0))
+
+        num_shards, shard_id = get_worker_shard(self._num_shards, self._shard_id)
+        if self._n_processes > 1:
+            shard_ids = range(shard_id * self._n_processes, (shard_id + 1) * self._n_processes)
+            yield from iterate_in_processes(self._iterate_on_shard, num_shards * self._n_processes, shard_ids)
+        else:
+            yield from self._iterate_on_shard(num_shards, shard_id)
+
+    def _iterate_on_shard(self, num_shards, shard_id):
+        n_samples_done = 0
+        for n_stories_done, (url, dialog_tree) in enumerate(self._iterate_on_dialog_trees(num_shards, shard_id), 1):
+            if self._logging_period and n_stories_done % self._logging_period == 0:
+                _logger.info(f'Pikabu lines: {n_stories_done}, samples: {n_samples_done}')
+
+            subdialogs = dialog_tree.iterate_on_unique_dialogs(
+                get_key=_get_utterance_text, as_references=self._yield_references)
+
+            for subdialog in subdialogs:
+                n_samples_done += 1
+                if self._yield_references:
+                    yield (url, ) + subdialog
                 else:
-                    data = None
-
-                tree.create_node(identifier=id_, parent=parent_id, data=data)
+                    yield tuple(subdialog)
 
-        return tree
+    def _iterate_on_dialog_trees(self, num_shards, shard_id):
+        if self._cache_path is not None:
+            tree_arrays = _iterate_on_columnar_tree_arrays(self._cache_path, num_shards, shard_id, _get_cached_node_data)
+        else:
+            tree_arrays = self._iterate_on_source_tree_arrays(num_shards, shard_id)
 
-    def _process_comment(self, text) -> Optional[str]:
-        if not text:
-            return None
+        for url, comment_ids, parents, data in tree_arrays:
+            yield url, CommentTree(comment_ids, parents, data)
 
-        if '@' in text or 'http' in text:
-            return None
+    def _iterate_on_source_tree_arrays(self, num_shards, shard_id):
+        if self._is_columnar:
+            yield from _iterate_on_columnar_tree_arrays(self._file_path, num_shards, shard_id, self._get_node_data)
+        else:
+            for _, raw_line in iterate_on_file_shard_lines(self._file_path, num_shards=num_shards, shard_id=shard_id):
+                line_data = json.loads(raw_line)
+                yield (line_data['url'], ) + get_tree_arrays(line_data['comments'], self._get_comment_node_data)
 
-        n_words = len(re.findall(r'\w+', text))
-        if n_words > self._max_n_words_per_utterance:
-            return None
+    def _get_comment_node_data(self, id_, comment_json):
+        return self._get_node_data(id_, comment_json['text'], comment_json.get('meta'))
 
-        text = text.strip()
-        if text.startswith('Комментарий удален.'):
+    def _get_node_data(self, id_, text, meta):
+        comment_text = self._comment_filter(id_, text)
+        if comment_text:
+            return {'text': comment_text, 'meta': meta}
+        else:
             return None
 
-        return text
-
 
 class PikabuDialogsIterator(PikabuDialogsWithMetaIterator):
-    def __init__(self, file_path, max_n_words_per_utterance, logging_period=10000):
-        super().__init__(file_path, max_n_words_per_utterance=max_n_words_per_utterance, logging_period=logging_period)
-
-    def __iter__(self):
-        for subdialog in super().__iter__():
+    def __init__(
+            self,
+            file_path,
+            max_n_words_per_utterance,
+            logging_period=10000,
+            num_shards=1,
+            shard_id=0,
+            n_processes=1,
+            comment_filter=None,
+            cache_dir=None):
+        super().__init__(
+            file_path,
+            max_n_words_per_utterance=max_n_words_per_utterance,
+            logging_period=logging_period,
+            num_shards=num_shards,
+            shard_id=shard_id,
+            n_processes=n_processes,
+            comment_filter=comment_filter,
+            cache_dir=cache_dir)
+
+    def _iterate_on_shard(self, num_shards, shard_id):
+        for subdialog in super()._iterate_on_shard(num_shards, shard_id):
             utterances = [utterance['text'] for utterance in subdialog]
             yield utterances
 
@@ -101,11 +149,28 @@ LOW_RATING_LABEL = 3
 
 
 class PikabuDialogsWithResponseRatingIterator(PikabuDialogsWithMetaIterator):
-    def __init__(self, file_path, max_n_words_per_utterance, logging_period=10000):
-        super().__init__(file_path, max_n_words_per_utterance=max_n_words_per_utterance, logging_period=logging_period)
-
-    def __iter__(self):
-        for subdialog in super().__iter__():
+    def __init__(
+            self,
+            file_path,
+            max_n_words_per_utterance,
+            logging_period=10000,
+            num_shards=1,
+            shard_id=0,
+            n_processes=1,
+            comment_filter=None,
+            cache_dir=None):
+        super().__init__(
+            file_path,
+            max_n_words_per_utterance=max_n_words_per_utterance,
+            logging_period=logging_period,
+            num_shards=num_shards,
+            shard_id=shard_id,
+            n_processes=n_processes,
+            comment_filter=comment_filter,
+            cache_dir=cache_dir)
+
+    def _iterate_on_shard(self, num_shards, shard_id):
+        for subdialog in super()._iterate_on_shard(num_shards, shard_id):
             utterances = [utterance['text'] for utterance in subdialog]
             response_meta = subdialog[-1]['meta']
             response_rating_label = _get_rating_from_meta(response_meta)
@@ -132,27 +197,19 @@ def _get_rating_from_meta(response_meta):
     return label
 
 
-class _Dialog:
-    def __init__(self, utterance_dicts):
-        self._utterance_dicts = utterance_dicts
-
-    def __iter__(self):
-        yield from self._utterance_dicts
-
-    def __hash__(self):
-        return hash(tuple(d['text'] for d in self))
-
-    def __eq__(self, other):
-        return hash(self) == hash(other)
+def _iterate_on_columnar_tree_arrays(dir_path, num_shards, shard_id, get_node_data):
+    with PikabuColumnarStories(dir_path) as stories:
+        start, end = get_shard_range(len(stories), num_shards=num_shards, shard_id=shard_id)
+        for url, comment_ids, parents, texts, metas in stories.iterate(start, end):
+            data = [None]
+            data.extend(map(get_node_data, comment_ids[1:], texts[1:], metas[1:]))
+            yield url, comment_ids, parents, data
 
 
-def _iterate_on_dialogs_from_tree(dialog_tree: Tree):
-    for path in dialog_tree.paths_to_leaves():
-        path = path[1:]  # Skip dummy root node
-        dialog = [dialog_tree[p].data for p in path]
+def _get_cached_node_data(id_, text, meta):
+    # Filtered out comments are cached with empty texts.
+    return {'text': text, 'meta': meta} if text else None
 
-        # Split dialog on parts by empty utterance:
-        dialogs = iterate_on_parts_by_condition(dialog, lambda utterance: not utterance)
 
-        for dialog in dialogs:
-            yield _Dialog(dialog)
+def _get_utterance_text(utterance):
+    return utterance['text']
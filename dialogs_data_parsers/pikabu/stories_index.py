@@ -0,0 +1,189 @@
+import datetime
+import json
+import logging
+from pathlib import Path
+
+from dialogs_data_parsers.utils import read_last_line, truncate_partial_last_record
+
+_logger = logging.getLogger(__name__)
+_PIKABU_TIMEZONE = datetime.timezone(datetime.timedelta(hours=3))
+
+
+class PikabuStoriesIndex:
+    """Sidecar index of the pikabu stories jsonl file.
+
+    For each story line the index stores its byte offset and length together with the fields which are needed for
+    filtering (url, story id, comments count, timestamp, tags). The index is a jsonl file `<stories_file>.index`. It
+    is updated incrementally: only the bytes appended to the stories file after the last update are scanned.
+    """
+
+    def __init__(self, stories_file_path):
+        self._stories_file_path = Path(stories_file_path)
+        self._index_file_path = get_index_file_path(stories_file_path)
+
+        self._url_to_entry = None
+        self._id_to_entry = None
+
+    def update(self):
+        """Indexes new complete lines appended to the stories file since the last update and returns new entries."""
+        truncate_partial_last_record(self._index_file_path)
+        indexed_size = self._get_indexed_size()
+        if not self._stories_file_path.is_file() or self._stories_file_path.stat().st_size == indexed_size:
+            return []
+
+        new_entries = []
+        with open(self._stories_file_path, 'rb') as stories_file, open(self._index_file_path, 'a') as index_file:
+            stories_file.seek(indexed_size)
+            offset = indexed_size
+            for raw_line in stories_file:
+                if not raw_line.endswith(b'\n'):
+                    # Partially written line, it will be indexed during the next update.
+                    break
+
+                try:
+                    story_data = json.loads(raw_line)
+                except json.JSONDecodeError:
+                    _logger.warning(f'Skipping corrupted story line at offset {offset}: {self._stories_file_path}')
+                else:
+                    entry = get_index_entry(story_data, offset=offset, length=len(raw_line))
+                    index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                    self._add_entry(entry)
+                    new_entries.append(entry)
+
+                offset += len(raw_line)
+
+        _logger.debug(f'Stories index updated, new entries: {len(new_entries)}')
+
+        return new_entries
+
+    def add(self, stories_offsets_lengths):
+        """Appends entries of the stories which were just written to the end of the stories file.
+
+        :param stories_offsets_lengths: List of (story_data, offset, length) tuples in the file order.
+        """
+        with open(self._index_file_path, 'a') as index_file:
+            for story_data, offset, length in stories_offsets_lengths:
+                entry = get_index_entry(story_data, offset=offset, length=length)
+                index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                self._add_entry(entry)
+
+    def __len__(self):
+        return len(self._get_url_to_entry())
+
+    def __contains__(self, url):
+        return url in self._get_url_to_entry()
+
+    @property
+    def urls(self):
+        return self._get_url_to_entry().keys()
+
+    def get_by_url(self, url):
+        entry = self._get_url_to_entry().get(url)
+        return self._read_story(entry) if entry else None
+
+    def get_by_id(self, story_id):
+        self._get_url_to_entry()
+        entry = self._id_to_entry.get(int(story_id))
+        return self._read_story(entry) if entry else None
+
+    def iterate(self, start_time=None, end_time=None, tag=None, min_comments_count=None):
+        """Yields stories which match all the given filters in the file order.
+
+        Only the matched lines are read and decoded.
+
+        :param start_time: Inclusive lower bound of the story time (datetime or iso format string). Naive values
+            are treated as pikabu (Moscow, UTC+3) time.
+        :param end_time: Exclusive upper bound of the story time, same format as `start_time`.
+        :param tag: Story tag which must be present in the story tags.
+        :param min_comments_count: Minimum number of story comments.
+        """
+        start_time = _to_datetime(start_time)
+        end_time = _to_datetime(end_time)
+
+        entries = sorted(self._get_url_to_entry().values(), key=lambda entry: entry['offset'])
+        with open(self._stories_file_path, 'rb') as stories_file:
+            for entry in entries:
+                if start_time is not None or end_time is not None:
+                    if entry['timestamp'] is None:
+                        continue
+
+                    story_time = _to_datetime(entry['timestamp'])
+                    if start_time is not None and story_time < start_time:
+                        continue
+                    if end_time is not None and story_time >= end_time:
+                        continue
+
+                if tag is not None and tag not in entry['tags']:
+                    continue
+
+                if min_comments_count is not None and entry['comments_count'] < min_comments_count:
+                    continue
+
+                stories_file.seek(entry['offset'])
+                yield json.loads(stories_file.read(entry['length']))
+
+    def _read_story(self, entry):
+        with open(self._stories_file_path, 'rb') as stories_file:
+            stories_file.seek(entry['offset'])
+            return json.loads(stories_file.read(entry['length']))
+
+    def _get_url_to_entry(self):
+        if self._url_to_entry is None:
+            self._url_to_entry = {}
+            self._id_to_entry = {}
+            if self._index_file_path.is_file():
+                with open(self._index_file_path) as index_file:
+                    for line in index_file:
+                        self._add_entry(json.loads(line))
+
+        return self._url_to_entry
+
+    def _add_entry(self, entry):
+        if self._url_to_entry is not None:
+            self._url_to_entry[entry['url']] = entry
+            if entry['id'] is not None:
+                self._id_to_entry[entry['id']] = entry
+
+    def _get_indexed_size(self):
+        last_line = read_last_line(self._index_file_path)
+        if not last_line:
+            return 0
+
+        last_entry = json.loads(last_line)
+        return last_entry['offset'] + last_entry['length']
+
+
+def get_index_file_path(stories_file_path):
+    stories_file_path = Path(stories_file_path)
+    return stories_file_path.with_name(stories_file_path.name + '.index')
+
+
+def get_index_entry(story_data, offset, length):
+    url = story_data['url']
+    story = story_data['story'] or {}
+    story_id = url.split('_')[-1]
+
+    entry = {
+        'url': url,
+        'id': int(story_id) if story_id.isdigit() else None,
+        'offset': offset,
+        'length': length,
+        'comments_count': story.get('comments_count', 0),
+        'timestamp': story.get('timestamp'),
+        'tags': story.get('tags', [])
+    }
+
+    return entry
+
+
+def _to_datetime(value):
+    if value is None:
+        return None
+
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.fromisoformat(value)
+
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=_PIKABU_TIMEZONE)
+
+    return value
@@ -3,17 +3,20 @@ import copy
 import json
 import logging
 import re
+from collections import Counter
+from itertools import chain
 from pathlib import Path
 
-import aiofiles
 import bs4
-from more_itertools import chunked
 
 from dialogs_data_parsers.common.crawler import Crawler
+from dialogs_data_parsers.common.jsonl_writer import AsyncJsonlWriter
+from dialogs_data_parsers.common.persistent_hash_set import CompactHashSet, PersistentHashSet, get_hash
+from dialogs_data_parsers.common.work_queue import run_workers
+from dialogs_data_parsers.pikabu.stories_index import PikabuStoriesIndex
 
 _logger = logging.getLogger(__name__)
 _GET_COMMENTS_URL = 'https://pikabu.ru/ajax/comments_actions.php'
-_URLS_CHUNK_SIZE = 1000
 
 
 def iterate_on_urls(story_links_dir):
@@ -24,40 +27,128 @@ def iterate_on_urls(story_links_dir):
 
 
 class PikabuStoryCrawler(Crawler):
-    def __init__(self, concurrency, timeout, retries, story_links, out_file_path):
-        super().__init__(concurrency=concurrency, timeout=timeout, retries=retries)
+    def __init__(
+            self,
+            concurrency,
+            timeout,
+            retries,
+            story_links,
+            out_file_path,
+            limit_per_host=None,
+            n_parse_workers=0,
+            max_concurrency=None,
+            max_rate=None,
+            page_archive_dir=None,
+            replay=False,
+            previous_stories_file_path=None):
+        """
+        :param previous_stories_file_path: Optional stories file of the previous crawl (generation). If set, the
+            crawler refreshes it into the new generation `out_file_path`: stories of the previous generation (and new
+            story links) are crawled again, but if the story page comments count hasn't changed, the stored comments
+            are kept without requesting them. Otherwise, only the comments pages after the stored `last_comment_id`
+            are requested and merged with the stored comments. Stories deleted since the previous crawl are kept.
+        """
+        if previous_stories_file_path is not None and Path(previous_stories_file_path).resolve() == Path(
+                out_file_path).resolve():
+            raise ValueError('Previous stories file must differ from the out file (new generation)')
+
+        super().__init__(
+            concurrency=concurrency,
+            timeout=timeout,
+            retries=retries,
+            limit_per_host=limit_per_host,
+            n_parse_workers=n_parse_workers,
+            max_concurrency=max_concurrency,
+            max_rate=max_rate,
+            page_archive_dir=page_archive_dir,
+            replay=replay)
 
         self._out_file_path = out_file_path
+        self._story_links = story_links
+        self._stories_index = PikabuStoriesIndex(out_file_path)
         self._parsed_urls = self._get_parsed_urls()
-        self._all_urls = set(story_links)
-        self._urls_to_parse = self._all_urls.difference(self._parsed_urls)
-        self._n_urls_to_parse = len(self._urls_to_parse)
+        self._n_urls_crawled = 0
+        self._writer = None
+
+        self._previous_stories_index = None
+        self._refresh_counter = Counter()
+        if previous_stories_file_path is not None:
+            self._previous_stories_index = PikabuStoriesIndex(previous_stories_file_path)
+            self._previous_stories_index.update()
+            _logger.info(f'Refreshing previous stories: {len(self._previous_stories_index)}')
 
     @classmethod
-    def from_story_links_dir(cls, concurrency, timeout, retries, story_links_dir, out_file_path):
+    def from_story_links_dir(
+            cls,
+            concurrency,
+            timeout,
+            retries,
+            story_links_dir,
+            out_file_path,
+            limit_per_host=None,
+            n_parse_workers=0,
+            max_concurrency=None,
+            max_rate=None,
+            page_archive_dir=None,
+            replay=False,
+            previous_stories_file_path=None):
         story_links = iterate_on_urls(story_links_dir)
         return cls(
             concurrency=concurrency,
             timeout=timeout,
             retries=retries,
             story_links=story_links,
-            out_file_path=out_file_path)
+            out_file_path=out_file_path,
+            limit_per_host=limit_per_host,
+            n_parse_workers=n_parse_workers,
+            max_concurrency=max_concurrency,
+            max_rate=max_rate,
+            page_archive_dir=page_archive_dir,
+            replay=replay,
+            previous_stories_file_path=previous_stories_file_path)
 
     async def run(self):
-        for urls_chunk in chunked(self._urls_to_parse, n=_URLS_CHUNK_SIZE):
-            coroutines = [self._crawl(url) for url in urls_chunk]
-            await asyncio.gather(*coroutines)
+        try:
+            async with AsyncJsonlWriter(self._out_file_path, on_batch_written=self._on_stories_written) as writer:
+                self._writer = writer
+                await run_workers(self._iterate_on_urls_to_parse(), self._crawl, n_workers=self._max_concurrency)
+        finally:
+            self._writer = None
+            self._parsed_urls.close()
+
+        if self._previous_stories_index is not None:
+            _logger.info(f'Refresh done, stories: {dict(self._refresh_counter)}')
 
     def _get_parsed_urls(self):
-        urls = set()
-        if Path(self._out_file_path).is_file():
-            with open(self._out_file_path) as file:
-                for line in file:
-                    url = line.split(',', maxsplit=1)[0].split('"')[-2]
-                    assert url.startswith('https')
-                    urls.add(url)
+        """Loads the hashes of already crawled urls from the append-only `<out_file>.done` log.
+
+        Stories which were written, but didn't get to the log before the interruption are recovered from the tail of
+        the out file via the stories index. If the log doesn't exist yet, it's built from the whole index once.
+        """
+        done_file_path = Path(str(self._out_file_path) + '.done')
+        is_done_file_exists = done_file_path.is_file()
+        parsed_urls = PersistentHashSet(done_file_path)
+
+        new_index_entries = self._stories_index.update()
+        urls = (entry['url'] for entry in new_index_entries) if is_done_file_exists else self._stories_index.urls
+        for url in urls:
+            parsed_urls.add(url)
+
+        _logger.info(f'Already crawled stories: {len(parsed_urls)}')
+
+        return parsed_urls
 
-        return urls
+    def _iterate_on_urls_to_parse(self):
+        urls = self._story_links
+        if self._previous_stories_index is not None:
+            urls = chain(list(self._previous_stories_index.urls), urls)
+
+        seen_url_hashes = CompactHashSet()
+        for url in urls:
+            url_hash = get_hash(url)
+            if url_hash not in seen_url_hashes and url not in self._parsed_urls:
+                seen_url_hashes.add(url_hash)
+                yield url
 
     async def _crawl(self, url):
         _logger.debug(f'Crawling story: {url}')
@@ -71,53 +162,111 @@ class PikabuStoryCrawler(Crawler):
             _logger.debug(f'Result is None for story: {url}')
             return
 
-        async with aiofiles.open(self._out_file_path, "a") as f:
-            result_str = json.dumps(result, ensure_ascii=False)
-            await f.write(result_str + '\n')
-            await f.flush()
-            _logger.debug(f'Story crawled and saved: {url}')
+        await self._writer.write(result)
+        _logger.debug(f'Story crawled and queued for saving: {url}')
+
+    def _on_stories_written(self, stories_offsets_lengths):
+        # Done log goes first: the index entries, which are missed after the interruption, are recovered from the
+        # out file tail, while the missed done hashes make the written stories to be crawled again:
+        for story_data, _, _ in stories_offsets_lengths:
+            self._parsed_urls.add(story_data['url'])
+        self._stories_index.add(stories_offsets_lengths)
 
     async def _get_story_and_comments(self, url):
         story_id = url.split('_')[-1]
+        previous_story_data = await self._get_previous_story_data(url)
         story_html = await self.perform_request(url, headers=_get_headers(), method='get')
 
         if not story_html:
             return None
 
-        story_soup = bs4.BeautifulSoup(story_html, features="html.parser")
+        story = await self.run_in_parse_executor(parse_story_html, story_html)
 
         # Page not exists (deleted)
-        if story_soup.find('div', {'class': 'app-404'}):
+        if story is None:
             _logger.debug(f'404 for story: {url}')
+            if previous_story_data is not None:
+                self._refresh_counter['n_deleted'] += 1
+                return previous_story_data
             return {'url': url, 'story': None, 'comments': []}
 
-        story = _parse_story_soup(story_soup)
-
         parser = _CommentsParser()
         start_comment_id = 0
+        if previous_story_data is not None:
+            start_comment_id = _get_last_comment_id(previous_story_data)
+            if story['comments_count'] == previous_story_data['story']['comments_count']:
+                self._refresh_counter['n_unchanged'] += 1
+                return dict(previous_story_data, story=story, last_comment_id=start_comment_id)
+
+            parser.load_comments(previous_story_data['comments'])
+
+        try:
+            last_comment_id = await self._crawl_comments(url, story_id, parser, start_comment_id)
+        except KeyError as e:
+            if previous_story_data is None:
+                raise
+            _logger.warning(f'Parent comment {e} is not loaded, previous comments are kept: {url}')
+            last_comment_id = None
+
+        if previous_story_data is not None:
+            if last_comment_id is None:
+                # Previous data is kept as is, so the comments are requested again by the next refresh:
+                self._refresh_counter['n_failed_kept_previous'] += 1
+                return previous_story_data
+            self._refresh_counter['n_updated'] += 1
+        elif last_comment_id is None:
+            return None
+        elif self._previous_stories_index is not None:
+            is_previously_deleted = url in self._previous_stories_index
+            self._refresh_counter['n_previously_deleted' if is_previously_deleted else 'n_new'] += 1
+
+        self._n_urls_crawled += 1
+        _logger.info(f'{url} Comments: {parser.n_comments_parsed}, Crawled: {self._n_urls_crawled}')
+
+        result = {'url': url, 'story': story, 'comments': parser.id_to_comment, 'last_comment_id': last_comment_id}
+        return result
+
+    async def _crawl_comments(self, url, story_id, parser, start_comment_id):
+        """Requests the comments pages after the `start_comment_id` and adds them to the parser. Returns the
+        pagination cursor of the last non-empty page or None, if the request has failed."""
+        last_comment_id = start_comment_id
         prev_n_comments_parsed = None
         while prev_n_comments_parsed != parser.n_comments_parsed:
             data = _get_payload_data(story_id, start_comment_id)
             headers = _get_headers(url)
             result = await self.perform_request(_GET_COMMENTS_URL, headers=headers, data=data, method='post')
+            if result is None:
+                return None
 
             _logger.debug(f'Parsing result for story: {url}')
 
             result_data = json.loads(result)['data']
             start_comment_id = result_data['last_id']
+            if result_data['comments']:
+                last_comment_id = start_comment_id
             prev_n_comments_parsed = parser.n_comments_parsed
 
-            for comment_data in result_data['comments']:
-                comment_soup = bs4.BeautifulSoup(comment_data['html'], features="html.parser")
-                parser.parse_comment_and_children(comment_soup)
+            comments_htmls = [comment_data['html'] for comment_data in result_data['comments']]
+            comments = await self.run_in_parse_executor(parse_comments_htmls, comments_htmls)
+            parser.add_comments(comments)
 
             _logger.debug(f'{parser.n_comments_parsed} comments parsed: {url}')
 
-        self._n_urls_to_parse -= 1
-        _logger.info(f'{url} Comments: {parser.n_comments_parsed}, Left: {self._n_urls_to_parse}')
+        return last_comment_id
 
-        result = {'url': url, 'story': story, 'comments': parser.id_to_comment}
-        return result
+    async def _get_previous_story_data(self, url):
+        """Returns the previous generation story data, if it's not deleted, or None."""
+        if self._previous_stories_index is None:
+            return None
+
+        # Story reading and json decoding don't block the event loop (the index entries are loaded in the constructor,
+        # and each read opens its own file, so it's safe to read from the executor threads):
+        loop = asyncio.get_event_loop()
+        story_data = await loop.run_in_executor(None, self._previous_stories_index.get_by_url, url)
+        if story_data is None or story_data['story'] is None:
+            return None
+
+        return story_data
 
 
 class _CommentsParser:
@@ -136,17 +285,53 @@ class _CommentsParser:
 
         return id_to_comment
 
-    def parse_comment_and_children(self, comment_soup):
-        comment_soups = comment_soup.find_all('div', {'class': 'comment'})
-
-        for comment_soup in comment_soups:
-            comment = _parse_comment_soup(comment_soup)
+    def load_comments(self, id_to_comment):
+        """Loads the already parsed comments (in the `id_to_comment` format)."""
+        for comment in id_to_comment.values():
+            self._id_to_comment[comment['id']] = dict(comment, children=set(comment['children']))
+
+    def add_comments(self, comments):
+        for comment in comments:
+            previous_comment = self._id_to_comment.get(comment['id'])
+            if previous_comment is not None:
+                # Comment is requested again, its already known children are kept:
+                comment['children'].update(previous_comment['children'])
             self._id_to_comment[comment['id']] = comment
             parent_id = comment['parent_id']
             if parent_id != 0:
                 self._id_to_comment[parent_id]['children'].add(comment['id'])
 
 
+def _get_last_comment_id(story_data):
+    """Returns the comments pagination cursor of the stored story. Stories which were crawled without it fall back
+    to the max comment id (comment ids grow with time)."""
+    last_comment_id = story_data.get('last_comment_id')
+    if last_comment_id is None:
+        last_comment_id = max((comment['id'] for comment in story_data['comments'].values()), default=0)
+
+    return last_comment_id
+
+
+def parse_story_html(story_html):
+    """Parses story page. Returns None if the story doesn't exist (deleted)."""
+    story_soup = bs4.BeautifulSoup(story_html, features="html.parser")
+    if story_soup.find('div', {'class': 'app-404'}):
+        return None
+
+    return _parse_story_soup(story_soup)
+
+
+def parse_comments_htmls(comments_htmls):
+    """Parses html fragments of the comments (and their children) returned by the comments ajax endpoint."""
+    comments = []
+    for comment_html in comments_htmls:
+        comment_soup = bs4.BeautifulSoup(comment_html, features="html.parser")
+        for comment_soup in comment_soup.find_all('div', {'class': 'comment'}):
+            comments.append(_parse_comment_soup(comment_soup))
+
+    return comments
+
+
 def _parse_comment_soup(soup):
     body = soup.find('div', {'class': 'comment__body'})
     meta = soup['data-meta']
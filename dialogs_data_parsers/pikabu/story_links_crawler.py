@@ -1,4 +1,3 @@
-import asyncio
 import datetime
 import json
 import logging
@@ -7,12 +6,11 @@ from pathlib import Path
 
 import aiofiles
 import bs4
-from more_itertools import chunked
 
 from dialogs_data_parsers.common.crawler import Crawler
+from dialogs_data_parsers.common.work_queue import run_workers
 
 _logger = logging.getLogger(__name__)
-_DAYS_CHUNK_SIZE = 30
 
 
 def _get_days_range(start_day, end_day):
@@ -24,8 +22,31 @@ def _get_days_range(start_day, end_day):
 
 
 class PikabuStoryLinksCrawler(Crawler):
-    def __init__(self, concurrency, timeout, retries, out_dir, start_day, end_day, pikabu_section):
-        super().__init__(concurrency=concurrency, timeout=timeout, retries=retries)
+    def __init__(
+            self,
+            concurrency,
+            timeout,
+            retries,
+            out_dir,
+            start_day,
+            end_day,
+            pikabu_section,
+            limit_per_host=None,
+            n_parse_workers=0,
+            max_concurrency=None,
+            max_rate=None,
+            page_archive_dir=None,
+            replay=False):
+        super().__init__(
+            concurrency=concurrency,
+            timeout=timeout,
+            retries=retries,
+            limit_per_host=limit_per_host,
+            n_parse_workers=n_parse_workers,
+            max_concurrency=max_concurrency,
+            max_rate=max_rate,
+            page_archive_dir=page_archive_dir,
+            replay=replay)
 
         self._out_dir = out_dir
         self._start_day = start_day
@@ -37,11 +58,10 @@ class PikabuStoryLinksCrawler(Crawler):
         Path(self._out_dir).mkdir(exist_ok=True, parents=True)
         days_range = _get_days_range(self._start_day, self._end_day)
         parsed_days = [path.name for path in Path(self._out_dir).iterdir()]
-        days_range = set(days_range) - set(parsed_days)
+        parsed_days = set(parsed_days)
+        days_range = (day for day in days_range if day not in parsed_days)
 
-        for days_chunk in chunked(days_range, n=_DAYS_CHUNK_SIZE):
-            coroutines = [self._crawl(day) for day in days_chunk]
-            await asyncio.gather(*coroutines)
+        await run_workers(days_range, self._crawl, n_workers=self._max_concurrency)
 
     async def _crawl(self, day):
         links = await self._get_story_links(day=day)
@@ -61,14 +81,8 @@ class PikabuStoryLinksCrawler(Crawler):
             params = _get_params(page_number=current_page_id)
             response_text = await self.perform_request(url=url, headers=headers, params=params, method='get')
             stories = json.loads(response_text)['data']['stories']
-            story_soups = [bs4.BeautifulSoup(s['html'], features="html.parser") for s in stories]
-
-            for story_soup in story_soups:
-                link_element = story_soup.find('a', {'class': 'story__title-link'})
-                if link_element is not None:
-                    href = link_element.get('href')
-                    if href:
-                        links.add(href)
+            stories_htmls = [story['html'] for story in stories]
+            links.update(await self.run_in_parse_executor(parse_story_links, stories_htmls))
 
             new_number_of_links = len(links)
 
@@ -84,6 +98,20 @@ class PikabuStoryLinksCrawler(Crawler):
         return links
 
 
+def parse_story_links(stories_htmls):
+    """Parses story links from the html fragments of the feed page stories."""
+    links = []
+    for story_html in stories_htmls:
+        story_soup = bs4.BeautifulSoup(story_html, features="html.parser")
+        link_element = story_soup.find('a', {'class': 'story__title-link'})
+        if link_element is not None:
+            href = link_element.get('href')
+            if href:
+                links.append(href)
+
+    return links
+
+
 def _get_headers(day, pikabu_section):
     headers = {'referer': f'https://pikabu.ru/{pikabu_section}/{day}'}
     return headers
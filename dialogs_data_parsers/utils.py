@@ -1,3 +1,13 @@
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+
+
 def iterate_on_parts_by_condition(iterable, condition):
     cur_chunk = []
     for elem in iterable:
@@ -9,3 +19,96 @@ def iterate_on_parts_by_condition(iterable, condition):
 
     if cur_chunk:
         yield cur_chunk
+
+
+def get_file_fingerprint(file_path):
+    """Returns the json-serializable (size, mtime) of the file, which changes when the file is rewritten."""
+    stat = Path(file_path).stat()
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def get_xml_local_tag_name(tag):
+    """Returns the lower-cased tag name without the namespace."""
+    return tag.rsplit('}', maxsplit=1)[-1].lower()
+
+
+@contextmanager
+def open_atomic(file_path, mode='w', fsync=False):
+    """Opens a temporary file next to `file_path`, which replaces the file on the successful exit, so the readers
+    (and the next runs after a crash) never see a partially written file. Temporary file name is unique per process
+    and thread, so concurrent writers of the same file don't clash.
+
+    :param fsync: If True, the file is flushed to the disk before the replace.
+    """
+    file_path = Path(file_path)
+    tmp_file_path = file_path.with_name(f'{file_path.name}.tmp-{os.getpid()}-{threading.get_ident()}')
+    try:
+        with open(tmp_file_path, mode) as file:
+            yield file
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+    except BaseException:
+        tmp_file_path.unlink(missing_ok=True)
+        raise
+
+    os.replace(tmp_file_path, file_path)
+
+
+def merge_files(file_paths, out_file_path, remove=False):
+    """Concatenates the files into the out file (atomically, see `open_atomic`).
+
+    :param remove: If True, the merged files are removed.
+    """
+    with open_atomic(out_file_path, 'wb') as out_file:
+        for file_path in file_paths:
+            with open(file_path, 'rb') as file:
+                shutil.copyfileobj(file, out_file)
+
+    if remove:
+        for file_path in file_paths:
+            os.remove(file_path)
+
+
+def truncate_partial_last_record(file_path, record_size=None):
+    """Truncates the partially written (e.g. on a crash) last record of the append-only file, if any.
+
+    :param record_size: Size of the fixed-size binary records. If None, records are lines.
+    """
+    if not Path(file_path).is_file():
+        return
+
+    with open(file_path, 'rb+') as file:
+        file.seek(0, os.SEEK_END)
+        end = file.tell()
+        if record_size is not None:
+            n_partial_bytes = end % record_size
+        elif end == 0:
+            return
+        else:
+            file.seek(end - 1)
+            n_partial_bytes = 0 if file.read(1) == b'\n' else len(read_last_line(file_path))
+
+        if n_partial_bytes:
+            file.truncate(end - n_partial_bytes)
+            _logger.warning(f'Partially written last record truncated: {file_path}')
+
+
+def read_last_line(file_path, block_size=4096):
+    if not Path(file_path).is_file():
+        return None
+
+    with open(file_path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        end = file.tell()
+        position = end
+        tail = b''
+        while position > 0:
+            position = max(0, position - block_size)
+            file.seek(position)
+            tail = file.read(end - position)
+            if tail.rstrip(b'\n').rfind(b'\n') != -1:
+                break
+
+    lines = tail.rstrip(b'\n').rsplit(b'\n', maxsplit=1)
+    return lines[-1] or None
@@ -9,6 +9,34 @@ def _parse_args():
     parser.add_argument('--out_file_path', type=str, required=True)
     parser.add_argument('--n_samples', type=int, required=True)
     parser.add_argument('--augment_p', type=float, required=False, default=0.3)
+    parser.add_argument(
+        '--n_shards',
+        type=int,
+        required=False,
+        default=1,
+        help='Number of raw dialogs file shards. The output depends only on the seed and the number of shards. '
+        'The default single shard keeps the previous samples (the "head" sampling takes the first utterances of the '
+        'file). More shards are needed to use several workers, but they give different samples.')
+    parser.add_argument('--n_workers', type=int, required=False, default=1, help='Number of worker processes.')
+    parser.add_argument('--seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument(
+        '--sampling',
+        type=str,
+        required=False,
+        default='head',
+        choices=('head', 'reservoir'),
+        help='Take the first utterances of each shard ("head") or a uniform random sample ("reservoir").')
+    parser.add_argument(
+        '--stratify_by',
+        type=str,
+        required=False,
+        default=None,
+        choices=('length', 'separators'),
+        help='Stratify the reservoir sampling by the utterance length or by the presence of dialog separators.')
+    parser.add_argument(
+        '--skip_utterances_without_separators',
+        action='store_true',
+        help='Skip utterances without dialog separators (so without author words).')
 
     args = parser.parse_args()
     return args
@@ -20,9 +48,16 @@ def main():
         raw_dialogs_file_path=args.raw_dialogs_file_path,
         out_file_path=args.out_file_path,
         n_samples=args.n_samples,
-        augment_p=args.augment_p)
+        augment_p=args.augment_p,
+        n_shards=args.n_shards,
+        n_workers=args.n_workers,
+        seed=args.seed,
+        sampling=args.sampling,
+        stratify_by=args.stratify_by,
+        skip_utterances_without_separators=args.skip_utterances_without_separators)
 
-    samples_generator.run()
+    n_samples_done = samples_generator.run()
+    print(f'Samples: {n_samples_done}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,83 @@
+"""Benchmarks the dialogs iterators on the jsonl files against the same iterators on their columnar exports."""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from dialogs_data_parsers.flibusta.columnar_dialogs import FlibustaColumnarDialogs, export_flibusta_dialogs
+from dialogs_data_parsers.flibusta.dialogs_iterator import FlibustaDialogsIterator
+from dialogs_data_parsers.pikabu.columnar_stories import export_pikabu_stories
+from dialogs_data_parsers.pikabu.dialogs_iterator import PikabuDialogsIterator
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks jsonl vs columnar dialogs iteration.')
+    parser.add_argument('--flibusta_file_path', type=str, required=False, help='Path to the flibusta dialogs file.')
+    parser.add_argument('--pikabu_file_path', type=str, required=False, help='Path to the pikabu stories file.')
+    parser.add_argument(
+        '--max_n_words_per_utterance', type=int, required=False, default=100, help='Pikabu utterances filter.')
+
+    args = parser.parse_args()
+    return args
+
+
+def _iterate(iterator):
+    start_time = time.time()
+    n_samples = 0
+    checksum = 0
+    for sample in iterator:
+        n_samples += 1
+        # Order-independent checksum of the samples:
+        checksum ^= hash(str(sample))
+
+    return time.time() - start_time, n_samples, checksum
+
+
+def _benchmark(name, file_path, export, get_iterator, out_dir):
+    start_time = time.time()
+    export(file_path, out_dir)
+    print(f'{name}: export: {time.time() - start_time:.2f}s')
+
+    results = []
+    for source_name, source_path in (('jsonl', file_path), ('columnar', out_dir)):
+        elapsed_time, n_samples, checksum = _iterate(get_iterator(source_path))
+        results.append((n_samples, checksum))
+        print(f'{name}, {source_name}: iterate: {elapsed_time:.2f}s, {n_samples / elapsed_time:.0f} samples/s, '
+              f'{n_samples} samples')
+
+    print(f'{name}: results are identical: {results[0] == results[1]}')
+
+
+def _benchmark_flibusta_load(file_path, columnar_dir):
+    start_time = time.time()
+    with open(file_path, 'rb') as file:
+        n_dialogs = sum(1 for raw_line in file if json.loads(raw_line))
+    print(f'flibusta, jsonl: load all dialogs: {time.time() - start_time:.2f}s, {n_dialogs} dialogs')
+
+    start_time = time.time()
+    with FlibustaColumnarDialogs(columnar_dir) as dialogs:
+        n_dialogs = sum(1 for _, dialog in dialogs.iterate() if dialog)
+    print(f'flibusta, columnar: load all dialogs: {time.time() - start_time:.2f}s, {n_dialogs} dialogs')
+
+
+def main():
+    args = _parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.flibusta_file_path:
+            _benchmark(
+                'flibusta', args.flibusta_file_path, export_flibusta_dialogs,
+                lambda file_path: FlibustaDialogsIterator(file_path, logging_period=0),
+                Path(tmp_dir) / 'flibusta')
+            _benchmark_flibusta_load(args.flibusta_file_path, Path(tmp_dir) / 'flibusta')
+
+        if args.pikabu_file_path:
+            _benchmark(
+                'pikabu', args.pikabu_file_path, export_pikabu_stories,
+                lambda file_path: PikabuDialogsIterator(
+                    file_path, max_n_words_per_utterance=args.max_n_words_per_utterance, logging_period=0),
+                Path(tmp_dir) / 'pikabu')
+
+
+if __name__ == '__main__':
+    main()
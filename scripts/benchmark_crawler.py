@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import time
+
+from aiohttp import web
+
+from dialogs_data_parsers.common.crawler import Crawler
+from dialogs_data_parsers.common.work_queue import run_workers
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the crawler requests against a local stand-in server.')
+    parser.add_argument('--n_requests', type=int, required=False, default=2000, help='Number of requests.')
+    parser.add_argument('--concurrency', type=int, required=False, default=12, help='Number of concurrent requests.')
+    parser.add_argument('--port', type=int, required=False, default=8765, help='Local stand-in server port.')
+    parser.add_argument('--page_size', type=int, required=False, default=50000, help='Response size in bytes.')
+    parser.add_argument(
+        '--throttle',
+        action='store_true',
+        help='Stand-in server responds with 429 to the requests above its capacity. Compares the crawler '
+        'concurrency settings instead of the sessions.')
+    parser.add_argument(
+        '--server_capacity', type=int, required=False, default=24, help='Max concurrent requests of throttling server.')
+    parser.add_argument(
+        '--server_latency', type=float, required=False, default=0.02, help='Response latency of throttling server.')
+    parser.add_argument(
+        '--retry_after', type=float, required=False, default=None, help='Retry-After of the throttling server 429s.')
+
+    args = parser.parse_args()
+    return args
+
+
+class _StandInServer:
+    def __init__(self, port, page_size, capacity=None, latency=0.0, retry_after=None):
+        """
+        :param capacity: If set, the requests above this number of concurrent ones get 429 response.
+        """
+        self._port = port
+        self._page = 'x' * page_size
+        self._capacity = capacity
+        self._latency = latency
+        self._retry_after = retry_after
+        self._connections = set()
+        self._n_active = 0
+        self.n_throttled = 0
+        self._runner = None
+
+    @property
+    def n_connections(self):
+        return len(self._connections)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._port}/page'
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/page', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self._port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def reset(self):
+        self._connections.clear()
+        self.n_throttled = 0
+
+    async def _handle(self, request):
+        self._connections.add(request.transport.get_extra_info('peername'))
+        if self._capacity is not None and self._n_active >= self._capacity:
+            self.n_throttled += 1
+            headers = {'Retry-After': str(self._retry_after)} if self._retry_after is not None else None
+            return web.Response(status=429, headers=headers)
+
+        self._n_active += 1
+        try:
+            await asyncio.sleep(self._latency)
+        finally:
+            self._n_active -= 1
+
+        return web.Response(text=self._page)
+
+
+async def _benchmark_shared_session(server, n_requests, concurrency):
+    async with Crawler(concurrency=concurrency, timeout=10, retries=1) as crawler:
+        coroutines = [crawler.perform_request(server.url) for _ in range(n_requests)]
+        await asyncio.gather(*coroutines)
+
+
+async def _benchmark_session_per_request(server, n_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _perform_request():
+        async with semaphore, Crawler(concurrency=1, timeout=10, retries=1) as crawler:
+            await crawler.perform_request(server.url)
+
+    await asyncio.gather(*[_perform_request() for _ in range(n_requests)])
+
+
+async def _benchmark_throttling(server, n_requests, concurrency, max_concurrency):
+    async with Crawler(
+            concurrency=concurrency, timeout=10, retries=10, max_concurrency=max_concurrency,
+            backoff_base=0.1) as crawler:
+        start_time = time.time()
+        results = await _run_throttled_requests(crawler, server.url, n_requests, max_concurrency or concurrency)
+        elapsed_time = time.time() - start_time
+
+    n_pages = sum(result is not None for result in results)
+    print(f'concurrency: {concurrency}, max concurrency: {max_concurrency}: {n_pages / elapsed_time:.0f} pages/sec, '
+          f'pages: {n_pages}/{n_requests}, 429 responses: {server.n_throttled}')
+
+
+async def _run_throttled_requests(crawler, url, n_requests, n_workers):
+    results = []
+
+    async def _perform_request(_):
+        results.append(await crawler.perform_request(url))
+
+    await run_workers(range(n_requests), _perform_request, n_workers=n_workers)
+    return results
+
+
+async def _main(args):
+    if args.throttle:
+        await _main_throttling(args)
+        return
+
+    server = _StandInServer(port=args.port, page_size=args.page_size)
+    await server.start()
+
+    try:
+        for name, benchmark in (('session per request', _benchmark_session_per_request),
+                                ('shared session', _benchmark_shared_session)):
+            server.reset()
+            start_time = time.time()
+            await benchmark(server, n_requests=args.n_requests, concurrency=args.concurrency)
+            elapsed_time = time.time() - start_time
+            print(f'{name}: {args.n_requests / elapsed_time:.0f} requests/sec, '
+                  f'{server.n_connections} connections (handshakes)')
+    finally:
+        await server.stop()
+
+
+async def _main_throttling(args):
+    server = _StandInServer(
+        port=args.port,
+        page_size=args.page_size,
+        capacity=args.server_capacity,
+        latency=args.server_latency,
+        retry_after=args.retry_after)
+    await server.start()
+
+    try:
+        # Hand-tuned concurrency below and far above the server capacity vs the adaptive one:
+        for concurrency, max_concurrency in ((args.concurrency, None), (args.server_capacity * 4, None),
+                                             (args.concurrency, args.server_capacity * 4)):
+            server.reset()
+            await _benchmark_throttling(
+                server, n_requests=args.n_requests, concurrency=concurrency, max_concurrency=max_concurrency)
+    finally:
+        await server.stop()
+
+
+def main():
+    args = _parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_main(args))
+
+
+if __name__ == '__main__':
+    main()
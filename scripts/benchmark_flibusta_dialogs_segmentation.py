@@ -0,0 +1,111 @@
+"""Benchmarks the book text to dialogs stage against the previous implementation (re.split of the whole text,
+NFKC and uncompiled re.sub on each dialog line)."""
+import argparse
+import random
+import re
+import time
+import unicodedata
+from zipfile import ZipFile
+
+import bs4
+
+from dialogs_data_parsers.flibusta.book_text_extractors import iterate_on_text_lines
+from dialogs_data_parsers.flibusta.dialogs_parser import DIALOG_SEPARATORS, iterate_on_book_dialogs
+
+_WORDS = ('привет', 'как', 'дела', 'сказал', 'он', 'она', 'нормально', 'ясно', 'понятно', 'дом', 'ночь', 'hello',
+          'ещё', 'что', 'Москва', '1984')
+# Compatibility characters, which are changed by NFKC normalization:
+_COMPATIBILITY_WORDS = ('ﬁ', '½', '…', '№', 'ｘ')
+_COMPATIBILITY_WORDS_PROBABILITY = 0.02
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks flibusta book text to dialogs segmentation.')
+    parser.add_argument(
+        '--archive_path',
+        type=str,
+        required=False,
+        help='Path to the flibusta zip archive to take the book texts from. If not set, synthetic texts are used.')
+    parser.add_argument('--n_books', type=int, required=False, default=50, help='Number of books.')
+    parser.add_argument(
+        '--n_lines_per_book', type=int, required=False, default=10000, help='Number of lines in synthetic books.')
+    parser.add_argument('--seed', type=int, required=False, default=228, help='Random seed.')
+
+    args = parser.parse_args()
+    return args
+
+
+def _get_archive_book_texts(archive_path, n_books):
+    texts = []
+    with ZipFile(archive_path) as zip_file:
+        for file_name in zip_file.namelist()[:n_books]:
+            texts.append(bs4.BeautifulSoup(zip_file.read(file_name), features="html.parser").text)
+
+    return texts
+
+
+def _get_synthetic_book_texts(n_books, n_lines_per_book, seed):
+    rnd = random.Random(seed)
+    texts = []
+    for _ in range(n_books):
+        lines = []
+        for _ in range(n_lines_per_book):
+            line = ' '.join(rnd.choice(_WORDS) for _ in range(rnd.randint(3, 40)))
+            if rnd.random() < _COMPATIBILITY_WORDS_PROBABILITY:
+                line += ' ' + rnd.choice(_COMPATIBILITY_WORDS)
+            if rnd.random() < 0.5:
+                line = rnd.choice(DIALOG_SEPARATORS) + rnd.choice(('', ' ', '  ')) + line
+            lines.append(line + '\n' * rnd.randint(1, 2))
+        texts.append(''.join(lines))
+
+    return texts
+
+
+def _iterate_on_book_dialogs_reference(book_text):
+    dialog_separators_set = set(DIALOG_SEPARATORS)
+    dialog = []
+    for line in re.split('\n+', book_text):
+        line = line.strip()
+
+        if len(line) > 2 and line[0] in dialog_separators_set:
+            line = unicodedata.normalize("NFKC", line)
+            line = re.sub(r'^\W+', '', line)
+            dialog.append(line)
+        else:
+            if len(dialog) >= 2:
+                yield dialog
+
+            dialog = []
+
+    if len(dialog) >= 2:
+        yield dialog
+
+
+def _iterate_on_book_dialogs(book_text):
+    yield from iterate_on_book_dialogs(iterate_on_text_lines(book_text))
+
+
+def main():
+    args = _parse_args()
+    if args.archive_path:
+        texts = _get_archive_book_texts(args.archive_path, args.n_books)
+    else:
+        texts = _get_synthetic_book_texts(args.n_books, args.n_lines_per_book, args.seed)
+
+    n_mb = sum(len(text.encode()) for text in texts) / 2**20
+    print(f'Books: {len(texts)}, {n_mb:.1f} MB')
+
+    results = []
+    for iterate_on_book_dialogs_ in (_iterate_on_book_dialogs_reference, _iterate_on_book_dialogs):
+        start_time = time.time()
+        dialogs = [dialog for text in texts for dialog in iterate_on_book_dialogs_(text)]
+        elapsed_time = time.time() - start_time
+        results.append(dialogs)
+        print(f'{iterate_on_book_dialogs_.__name__}: {elapsed_time:.2f}s, {n_mb / elapsed_time:.1f} MB/s, '
+              f'{len(dialogs)} dialogs')
+
+    print(f'Results are identical: {results[0] == results[1]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Benchmarks the comments tree dialogs enumeration against the previous treelib-based implementation.
+
+Requires treelib (pip install treelib==1.6.1), which is not a dependency of the package anymore.
+"""
+import argparse
+import random
+import time
+
+from treelib import Tree
+
+from dialogs_data_parsers.pikabu.comment_tree import CommentTree
+from dialogs_data_parsers.utils import iterate_on_parts_by_condition
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks pikabu comments tree dialogs enumeration.')
+    parser.add_argument('--n_comments', type=int, required=False, default=20000, help='Number of comments in tree.')
+    parser.add_argument('--seed', type=int, required=False, default=228, help='Random seed.')
+
+    args = parser.parse_args()
+    return args
+
+
+def _get_comments(n_comments, get_parent_id, rnd):
+    comments = {}
+    for id_ in range(1, n_comments + 1):
+        text = None if rnd.random() < 0.05 else f'comment {rnd.randint(0, n_comments // 4)}'
+        comments[str(id_)] = {'text': text, 'parent_id': get_parent_id(id_)}
+
+    return comments
+
+
+def _get_synthetic_trees(n_comments, seed):
+    rnd = random.Random(seed)
+    return {
+        'deep': _get_comments(n_comments // 10, lambda id_: id_ - 1, rnd),
+        'wide': _get_comments(n_comments, lambda id_: 0 if id_ % 5 == 1 else id_ - (id_ - 1) % 5, rnd),
+        'random': _get_comments(n_comments, lambda id_: rnd.choice((0, rnd.randint(0, id_ - 1))), rnd),
+    }
+
+
+def _get_node_data(id_, comment):
+    return {'text': comment['text']} if comment['text'] else None
+
+
+def _get_subdialogs_treelib(comments):
+    tree = Tree()
+    tree.create_node(identifier=0)
+    for id_, comment in sorted((int(id_), comment) for id_, comment in comments.items()):
+        tree.create_node(identifier=id_, parent=int(comment['parent_id']), data=_get_node_data(id_, comment))
+
+    subdialogs = set()
+    for path in tree.paths_to_leaves():
+        dialog = [tree[p].data for p in path[1:]]
+        for part in iterate_on_parts_by_condition(dialog, lambda utterance: not utterance):
+            texts = tuple(utterance['text'] for utterance in part)
+            for n_utterances in range(2, len(texts) + 1):
+                subdialogs.add(texts[:n_utterances])
+
+    return subdialogs
+
+
+def _get_subdialogs_comment_tree(comments):
+    tree = CommentTree.from_comments(comments, _get_node_data)
+    return set(tuple(utterance['text'] for utterance in dialog) for dialog in tree.iterate_on_dialogs())
+
+
+def main():
+    args = _parse_args()
+    for name, comments in _get_synthetic_trees(args.n_comments, args.seed).items():
+        results = []
+        for get_subdialogs in (_get_subdialogs_treelib, _get_subdialogs_comment_tree):
+            start_time = time.time()
+            subdialogs = get_subdialogs(comments)
+            elapsed_time = time.time() - start_time
+            results.append(subdialogs)
+            print(f'{name} ({len(comments)} comments), {get_subdialogs.__name__}: {elapsed_time:.3f}s, '
+                  f'{len(subdialogs)} subdialogs')
+
+        print(f'{name}: results are identical: {results[0] == results[1]}')
+
+
+if __name__ == '__main__':
+    main()
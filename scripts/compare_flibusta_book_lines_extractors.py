@@ -0,0 +1,40 @@
+import argparse
+import time
+
+from dialogs_data_parsers.flibusta.dialogs_parser import iterate_on_archive_dialogs
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description='Checks that the flibusta book lines extractors produce identical dialogs on the archive.')
+    parser.add_argument('--archive_path', type=str, required=True, help='Path to the flibusta zip archive.')
+    parser.add_argument(
+        '--extractors',
+        type=str,
+        nargs=2,
+        required=False,
+        default=('bs4', 'streaming'),
+        help='Names of the two extractors to compare.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+
+    extractors_dialogs = []
+    for extractor in args.extractors:
+        start_time = time.time()
+        dialogs = list(iterate_on_archive_dialogs(args.archive_path, extractor))
+        print(f'{extractor}: {len(dialogs)} dialogs, {time.time() - start_time:.2f}s')
+        extractors_dialogs.append(dialogs)
+
+    first_dialogs, second_dialogs = extractors_dialogs
+    n_mismatches = sum(first != second for first, second in zip(first_dialogs, second_dialogs))
+    n_mismatches += abs(len(first_dialogs) - len(second_dialogs))
+    print(f'Mismatched dialogs: {n_mismatches}')
+
+
+if __name__ == '__main__':
+    main()
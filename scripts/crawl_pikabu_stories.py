@@ -13,9 +13,56 @@ def _parse_args():
         type=str,
         required=True,
         help='Path to the root pikabu results directory. Sub-directory with links will be created there.')
-    parser.add_argument('--concurrency', type=int, required=False, default=12, help='Number of concurrent requests.')
+    parser.add_argument(
+        '--concurrency', type=int, required=False, default=12, help='Initial number of concurrent requests.')
+    parser.add_argument(
+        '--max_concurrency',
+        type=int,
+        required=False,
+        default=None,
+        help='Max number of concurrent requests, which the concurrency adapts up to while the server copes with the '
+        'load (equals to concurrency by default).')
+    parser.add_argument(
+        '--max_rate', type=float, required=False, default=None, help='Max number of requests per second.')
     parser.add_argument('--timeout', type=int, required=False, default=10, help='Timeout in seconds.')
     parser.add_argument('--retries', type=int, required=False, default=5, help='Number of request retries.')
+    parser.add_argument(
+        '--limit_per_host',
+        type=int,
+        required=False,
+        default=None,
+        help='Max number of keep-alive connections to the host (equals to max concurrency by default).')
+    parser.add_argument(
+        '--n_parse_workers',
+        type=int,
+        required=False,
+        default=None,
+        help='Number of processes for html parsing. If 0, pages are parsed in the main process. '
+        'Defaults to 0, or to the number of cpus with --replay.')
+    parser.add_argument(
+        '--page_archive_dir',
+        type=str,
+        required=False,
+        default=None,
+        help='Path to the raw pages archive. If set, all the crawled pages are saved there.')
+    parser.add_argument(
+        '--replay',
+        action='store_true',
+        help='Re-parse pages from the --page_archive_dir without the network (e.g. after the parsing code changes).')
+    parser.add_argument(
+        '--out_file_name',
+        type=str,
+        required=False,
+        default='stories.jsonl',
+        help='Name of the stories file in the root directory (use a new one to replay the pages archive or to '
+        'refresh the previous stories).')
+    parser.add_argument(
+        '--previous_stories_file_path',
+        type=str,
+        required=False,
+        default=None,
+        help='Path to the previous stories file to refresh into the new generation --out_file_name. Only the story '
+        'pages and the new comments of the stories with changed comments count are requested.')
 
     args = parser.parse_args()
     return args
@@ -24,7 +71,7 @@ def _parse_args():
 def main():
     args = _parse_args()
 
-    out_file_path = os.path.join(args.root_dir, 'stories.jsonl')
+    out_file_path = os.path.join(args.root_dir, args.out_file_name)
     story_links_dir = os.path.join(args.root_dir, 'story_links')
     logs_dir = os.path.join(args.root_dir, 'logs')
     prepare_logging(logs_dir, log_files_prefix='stories_')
@@ -33,11 +80,30 @@ def main():
         concurrency=args.concurrency,
         timeout=args.timeout,
         retries=args.retries,
+        limit_per_host=args.limit_per_host,
+        n_parse_workers=_get_n_parse_workers(args),
+        max_concurrency=args.max_concurrency,
+        max_rate=args.max_rate,
+        page_archive_dir=args.page_archive_dir,
+        replay=args.replay,
+        previous_stories_file_path=args.previous_stories_file_path,
         story_links_dir=story_links_dir,
         out_file_path=out_file_path)
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(crawler.run())
+    loop.run_until_complete(_run_crawler(crawler))
+
+
+def _get_n_parse_workers(args):
+    if args.n_parse_workers is not None:
+        return args.n_parse_workers
+
+    return os.cpu_count() if args.replay else 0
+
+
+async def _run_crawler(crawler):
+    async with crawler:
+        await crawler.run()
 
 
 if __name__ == '__main__':
@@ -22,9 +22,48 @@ def _parse_args():
         required=False,
         default=_get_default_end_day(),
         help='Stories to crawl end day (%d-%m-%Y).')
-    parser.add_argument('--concurrency', type=int, required=False, default=12, help='Number of concurrent requests.')
+    parser.add_argument(
+        '--concurrency', type=int, required=False, default=12, help='Initial number of concurrent requests.')
+    parser.add_argument(
+        '--max_concurrency',
+        type=int,
+        required=False,
+        default=None,
+        help='Max number of concurrent requests, which the concurrency adapts up to while the server copes with the '
+        'load (equals to concurrency by default).')
+    parser.add_argument(
+        '--max_rate', type=float, required=False, default=None, help='Max number of requests per second.')
     parser.add_argument('--timeout', type=int, required=False, default=10, help='Timeout in seconds.')
     parser.add_argument('--retries', type=int, required=False, default=5, help='Number of request retries.')
+    parser.add_argument(
+        '--limit_per_host',
+        type=int,
+        required=False,
+        default=None,
+        help='Max number of keep-alive connections to the host (equals to max concurrency by default).')
+    parser.add_argument(
+        '--n_parse_workers',
+        type=int,
+        required=False,
+        default=None,
+        help='Number of processes for html parsing. If 0, pages are parsed in the main process. '
+        'Defaults to 0, or to the number of cpus with --replay.')
+    parser.add_argument(
+        '--page_archive_dir',
+        type=str,
+        required=False,
+        default=None,
+        help='Path to the raw pages archive. If set, all the crawled pages are saved there.')
+    parser.add_argument(
+        '--replay',
+        action='store_true',
+        help='Re-parse pages from the --page_archive_dir without the network (e.g. after the parsing code changes).')
+    parser.add_argument(
+        '--out_dir_name',
+        type=str,
+        required=False,
+        default='story_links',
+        help='Name of the links directory in the root directory (use a new one to replay the pages archive).')
     parser.add_argument('--pikabu_section', type=str, required=False, default='best', help='Pikabu section to crawl.')
 
     args = parser.parse_args()
@@ -39,20 +78,38 @@ def _get_default_end_day():
 def main():
     args = _parse_args()
 
-    out_dir = os.path.join(args.root_dir, 'story_links')
+    out_dir = os.path.join(args.root_dir, args.out_dir_name)
     logs_dir = os.path.join(args.root_dir, 'logs')
     prepare_logging(logs_dir, log_files_prefix='story_links_')
     crawler = PikabuStoryLinksCrawler(
         concurrency=args.concurrency,
         timeout=args.timeout,
         retries=args.retries,
+        limit_per_host=args.limit_per_host,
+        n_parse_workers=_get_n_parse_workers(args),
+        max_concurrency=args.max_concurrency,
+        max_rate=args.max_rate,
+        page_archive_dir=args.page_archive_dir,
+        replay=args.replay,
         out_dir=out_dir,
         start_day=args.start_day,
         end_day=args.end_day,
         pikabu_section=args.pikabu_section)
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(crawler.run())
+    loop.run_until_complete(_run_crawler(crawler))
+
+
+def _get_n_parse_workers(args):
+    if args.n_parse_workers is not None:
+        return args.n_parse_workers
+
+    return os.cpu_count() if args.replay else 0
+
+
+async def _run_crawler(crawler):
+    async with crawler:
+        await crawler.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+import argparse
+import json
+
+from dialogs_data_parsers.common.deduplication import DialogsDeduplicator
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description='Removes exact (and optionally near) duplicate dialogs from the dialogs jsonl file.')
+    parser.add_argument('--file_path', type=str, required=True, help='Path to the dialogs jsonl file.')
+    parser.add_argument('--out_file_path', type=str, required=True, help='Path to the deduplicated dialogs jsonl file.')
+    parser.add_argument(
+        '--near_duplicates',
+        action='store_true',
+        help='Remove near duplicates too (dialogs with similar word shingles, found by MinHash LSH).')
+    parser.add_argument(
+        '--n_workers', type=int, required=False, default=None, help='Number of worker processes. Defaults to CPUs.')
+    parser.add_argument(
+        '--n_partitions',
+        type=int,
+        required=False,
+        default=64,
+        help='Number of on-disk partitions of the dialog fingerprints. Increase it to reduce the memory usage.')
+    parser.add_argument(
+        '--tmp_dir',
+        type=str,
+        required=False,
+        default=None,
+        help='Directory for the spilled fingerprints. Defaults to the out file directory.')
+    parser.add_argument(
+        '--n_permutations', type=int, required=False, default=64, help='Number of MinHash permutations.')
+    parser.add_argument('--n_bands', type=int, required=False, default=16, help='Number of MinHash LSH bands.')
+    parser.add_argument(
+        '--shingle_size', type=int, required=False, default=3, help='Number of words in the dialog text shingles.')
+    parser.add_argument(
+        '--report_file_path', type=str, required=False, default=None, help='Optional path to the json report.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    deduplicator = DialogsDeduplicator(
+        file_path=args.file_path,
+        out_file_path=args.out_file_path,
+        near_duplicates=args.near_duplicates,
+        n_workers=args.n_workers,
+        n_partitions=args.n_partitions,
+        tmp_dir=args.tmp_dir,
+        n_permutations=args.n_permutations,
+        n_bands=args.n_bands,
+        shingle_size=args.shingle_size)
+    report = deduplicator.run()
+    print(json.dumps(report, indent=2))
+
+    if args.report_file_path:
+        with open(args.report_file_path, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
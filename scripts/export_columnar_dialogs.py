@@ -0,0 +1,27 @@
+import argparse
+
+from dialogs_data_parsers.flibusta.columnar_dialogs import export_flibusta_dialogs
+from dialogs_data_parsers.pikabu.columnar_stories import export_pikabu_stories
+
+_EXPORTERS = {'flibusta': export_flibusta_dialogs, 'pikabu': export_pikabu_stories}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description='Converts flibusta dialogs or pikabu stories jsonl file to the memory-mappable columnar format.')
+    parser.add_argument('--source', type=str, required=True, choices=list(_EXPORTERS), help='Data source of the file.')
+    parser.add_argument('--file_path', type=str, required=True, help='Path to the dialogs (stories) jsonl file.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Path to the output columnar directory.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    n_exported = _EXPORTERS[args.source](args.file_path, args.out_dir)
+    print(f'Exported: {n_exported}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import argparse
+
+from dialogs_data_parsers.pikabu.stories_index import PikabuStoriesIndex
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Builds or updates the byte-offset index of the pikabu stories file.')
+    parser.add_argument('--stories_file_path', type=str, required=True, help='Path to the stories jsonl file.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    index = PikabuStoriesIndex(args.stories_file_path)
+    new_entries = index.update()
+    print(f'New stories indexed: {len(new_entries)}, total: {len(index)}')
+
+
+if __name__ == '__main__':
+    main()
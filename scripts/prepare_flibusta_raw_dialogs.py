@@ -1,6 +1,7 @@
 import argparse
 
 from dialogs_data_parsers.common.log_config import prepare_logging
+from dialogs_data_parsers.flibusta.book_text_extractors import BOOK_LINES_EXTRACTORS
 from dialogs_data_parsers.flibusta.dialogs_parser import FlibustaDialogsParser
 
 
@@ -13,6 +14,44 @@ def _parse_args():
         help='Path to the dir with flibusta zip archives. Each archive contains fb2 files.')
     parser.add_argument('--out_file_path', type=str, required=True, help='Path to the output dialogs file.')
     parser.add_argument('--logs_dir', type=str, required=True, help='Path to the logs directory.')
+    parser.add_argument(
+        '--book_lines_extractor',
+        type=str,
+        required=False,
+        default='streaming',
+        choices=list(BOOK_LINES_EXTRACTORS),
+        help='Fb2 book lines extractor. "bs4" is the slow reference one.')
+    parser.add_argument(
+        '--sharded',
+        action='store_true',
+        help='Each worker writes its archive dialogs to a separate shard file without inter-process locking.')
+    parser.add_argument(
+        '--keep_shards', action='store_true', help='Do not merge shard files into the output file (with --sharded).')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Skip archives which were completely parsed by the previous run with the same output path '
+        '(with --sharded).')
+    parser.add_argument(
+        '--n_books_per_work_unit',
+        type=int,
+        required=False,
+        default=None,
+        help='Split archives on work units of this number of books. By default, each archive is a single work unit.')
+    parser.add_argument(
+        '--n_workers', type=int, required=False, default=None, help='Number of worker processes (cpu count by default).')
+    parser.add_argument(
+        '--skip_duplicate_books',
+        action='store_true',
+        help='Pre-pass fb2 headers of all archives and skip duplicate (by document id or authors and title) and '
+        'non-ru books before parsing their bodies.')
+    parser.add_argument(
+        '--book_index_file_path',
+        type=str,
+        required=False,
+        default=None,
+        help='Path to the persistent book index (with --skip_duplicate_books). '
+        'Defaults to <out_file_stem>.book_index.json.')
 
     args = parser.parse_args()
     return args
@@ -21,7 +60,17 @@ def _parse_args():
 def main():
     args = _parse_args()
     prepare_logging(args.logs_dir)
-    parser = FlibustaDialogsParser(args.flibusta_archives_dir, args.out_file_path)
+    parser = FlibustaDialogsParser(
+        args.flibusta_archives_dir,
+        args.out_file_path,
+        book_lines_extractor=args.book_lines_extractor,
+        sharded=args.sharded,
+        merge_shards=not args.keep_shards,
+        resume=args.resume,
+        n_books_per_work_unit=args.n_books_per_work_unit,
+        n_workers=args.n_workers,
+        skip_duplicate_books=args.skip_duplicate_books,
+        book_index_file_path=args.book_index_file_path)
     parser.run()
 
 
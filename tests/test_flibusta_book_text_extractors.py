@@ -0,0 +1,94 @@
+from collections import Counter
+from zipfile import ZipFile
+
+import pytest
+
+from dialogs_data_parsers.flibusta.book_text_extractors import \
+    iterate_on_book_lines_bs4, iterate_on_book_lines_streaming
+from dialogs_data_parsers.flibusta.dialogs_parser import iterate_on_archive_dialogs
+
+_BODY = '''<section>
+<title><p>Глава 1</p></title>
+<p>Они долго молчали.</p>
+<p>— Привет, как дела?</p>
+<p>— Нормально, <emphasis>честно</emphasis> говоря.</p>
+<p>— Ясно, <strong>понятно</strong>.</p>
+<empty-line/>
+<p>Он ушёл.</p>
+<p>— Куда ты?</p>
+<p>— Домой, <emphasis>конечно, </emphasis>куда же ещё.</p>
+</section>
+'''
+
+
+def _get_fb2(body=_BODY, lang='ru', encoding='utf-8'):
+    fb2 = f'''<?xml version="1.0" encoding="{encoding}"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">
+<description>
+<title-info>
+<author><first-name>Иван</first-name><last-name>Петров</last-name></author>
+<book-title>Книга</book-title>
+<lang>{lang}</lang>
+</title-info>
+</description>
+<body>
+{body}</body>
+<binary id="cover.jpg" content-type="image/jpeg">AAAA</binary>
+</FictionBook>
+'''
+    return fb2.encode(encoding)
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    archive_path = tmp_path / 'f.fb2-1-5.zip'
+    with ZipFile(archive_path, 'w') as zip_file:
+        zip_file.writestr('1.fb2', _get_fb2())
+        zip_file.writestr('2.fb2', _get_fb2(encoding='windows-1251'))
+        zip_file.writestr('3.fb2', _get_fb2(lang='en'))
+        zip_file.writestr('4.fb2', _get_fb2(body=_BODY.replace('<p>Он ушёл.</p>', '<p>Он ушёл.</q>')))
+        zip_file.writestr('5.fb2', _get_fb2(body=_BODY.replace('<p>— Куда ты?</p>', '<p>— Куда <b>ты?</p>')))
+
+    return archive_path
+
+
+def test_extractors_produce_same_dialogs(archive_path):
+    bs4_dialogs = list(iterate_on_archive_dialogs(archive_path, 'bs4'))
+    streaming_dialogs = list(iterate_on_archive_dialogs(archive_path, 'streaming'))
+
+    expected_dialogs = [
+        ['Привет, как дела?', 'Нормально, честно говоря.', 'Ясно, понятно.'],
+        ['Куда ты?', 'Домой, конечно, куда же ещё.'],
+    ]
+    # utf-8, windows-1251 and two malformed (parsed by the bs4 fallback) books, the non-ru book is skipped:
+    assert bs4_dialogs == expected_dialogs * 4
+    assert streaming_dialogs == bs4_dialogs
+
+
+def test_extractors_produce_same_lines(archive_path):
+    with ZipFile(archive_path) as zip_file:
+        for file_name in zip_file.namelist():
+            raw_fb2 = zip_file.read(file_name)
+            assert list(iterate_on_book_lines_streaming(raw_fb2)) == list(iterate_on_book_lines_bs4(raw_fb2))
+
+
+def test_paragraphs_on_one_line_are_merged():
+    # Book text is taken as is, so the paragraphs on one source line are one line (and one utterance):
+    fb2 = _get_fb2(body='<section>\n<p>— Привет!</p><p>— Пока!</p>\n</section>\n')
+
+    assert list(iterate_on_book_lines_streaming(fb2)) == list(iterate_on_book_lines_bs4(fb2))
+    assert [line for line in iterate_on_book_lines_streaming(fb2) if 'Привет' in line] == ['— Привет!— Пока!']
+
+
+def test_streaming_continues_book_after_late_parse_error():
+    n_paragraphs = 10000
+    body = ''.join(f'<p>— Реплика {i}</p>\n' for i in range(n_paragraphs))
+    # Html entity is undefined in xml, the error is after the first parsed chunk:
+    fb2 = _get_fb2(body=f'<section>\n{body}<p>Конец&nbsp;первой части</p>\n{body}</section>\n')
+    counter = Counter()
+
+    lines = list(iterate_on_book_lines_streaming(fb2, counter=counter))
+
+    assert counter == {'n_late_fallback_books': 1}
+    assert lines == list(iterate_on_book_lines_bs4(fb2))
+    assert len([line for line in lines if line.startswith('—')]) == 2 * n_paragraphs